@@ -0,0 +1,77 @@
+""" Timing of the construction of time controls on long simulations
+
+Run with: python benchmark_time_control.py
+"""
+import time
+
+import numpy
+import pandas
+
+from alinea.astk.TimeControl import evaluation_sequence, IterWithDelays, \
+    time_control, time_filter, date_filter, rain_events, rain_filter
+from alinea.astk.weather_generator import synthetic_weather
+
+
+def timeit(f, *args, **kwds):
+    t = time.time()
+    result = f(*args, **kwds)
+    return time.time() - t, result
+
+
+def bench_evaluation_sequence(steps=(100000, 1000000)):
+    rng = numpy.random.RandomState(0)
+    for n in steps:
+        hourly = [1] * n
+        random = rng.randint(1, 48, n // 24)
+        t, _ = timeit(evaluation_sequence, hourly)
+        print('evaluation_sequence, %d hourly delays: %.3f s' % (n, t))
+        t, seq = timeit(evaluation_sequence, random)
+        print('evaluation_sequence, %d random delays (%d steps): %.3f s' % (
+            len(random), len(seq), t))
+        t, _ = timeit(IterWithDelays, list(range(len(random))), random)
+        print('IterWithDelays, %d steps: %.3f s' % (len(seq), t))
+
+
+def bench_time_control(years=20, delay=3):
+    weather = synthetic_weather(periods=years * 8760)
+    data = weather.data
+    seq = data.index
+    eval_filter = numpy.arange(len(seq)) % delay == 0
+    starts = seq[eval_filter]
+
+    def truncate():
+        # per-window truncation, as done by the former time_control
+        return [data.truncate(before=start, after=end) for start, end in
+                zip(starts[:-1], starts[1:])]
+
+    print('time_control, %d years, every %d hours (%d windows):' % (
+        years, delay, len(starts)))
+    t, _ = timeit(truncate)
+    print('    truncate: %.2f s' % t)
+    t, _ = timeit(time_control, seq, eval_filter, data)
+    print('    time_control: %.3f s' % t)
+
+
+def bench_filters(steps=1000000, events=10000):
+    weather = synthetic_weather(periods=steps)
+    seq = weather.data.index
+    rng = numpy.random.RandomState(0)
+    calendar = seq[0] + pandas.to_timedelta(
+        rng.randint(0, steps * 60, events), unit='min')
+    print('filters on %d steps:' % steps)
+    t, _ = timeit(time_filter, seq, 3)
+    print('    time_filter: %.3f s' % t)
+    t, _ = timeit(date_filter, seq, calendar)
+    print('    date_filter, %d events: %.3f s' % (events, t))
+    t, _ = timeit(date_filter, seq, calendar, tolerance='30min')
+    print('    date_filter, %d snapped events: %.3f s' % (events, t))
+    t, table = timeit(rain_events, seq, weather)
+    print('    rain_events (%d events): %.3f s' % (len(table), t))
+    t, _ = timeit(rain_filter, seq, weather)
+    print('    rain_filter: %.3f s' % t)
+
+
+if __name__ == '__main__':
+    bench_evaluation_sequence()
+    bench_time_control()
+    bench_filters()
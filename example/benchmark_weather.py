@@ -0,0 +1,102 @@
+""" Timing of Weather loading and access on long synthetic series
+
+Run with: python benchmark_weather.py
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+import pandas
+
+from alinea.astk.Weather import Weather
+from alinea.astk.weather_generator import synthetic_weather
+
+
+def write_septo3d_file(path, years, start='1980-01-01 01:00'):
+    """ write a septo3d-like hourly meteo file of years length
+    """
+    dates = pandas.date_range(start, periods=years * 8760, freq='H')
+    n = len(dates)
+    rng = numpy.random.RandomState(0)
+    hour = dates.hour.values
+    hhmm = numpy.where(hour == 0, 2400, hour * 100)
+    day = numpy.where(hour == 0, dates.dayofyear.values - 1,
+                      dates.dayofyear.values)
+    year = dates.year.values
+    # midnight is written as hour 2400 of the previous day
+    first = (hour == 0) & (day == 0)
+    year = numpy.where(first, year - 1, year)
+    day = numpy.where(first, 365 + ((year % 4) == 0), day)
+    data = pandas.DataFrame(
+        {'An': year, 'Jour': day, 'Jsim': numpy.arange(n) // 24 + 1,
+         'hhmm': hhmm,
+         'PAR': numpy.maximum(0, numpy.sin(
+             (hour - 6) / 12. * numpy.pi)) * 1500,
+         'Tair': 12 + 8 * rng.randn(n), 'HR': rng.randint(30, 100, n),
+         'Vent': rng.rand(n) * 3, 'Pluie': rng.exponential(0.1, n)})
+    data.to_csv(path, sep='\t', index=False, float_format='%.3f')
+    return path
+
+
+def timeit(f, *args, **kwds):
+    t = time.time()
+    result = f(*args, **kwds)
+    return time.time() - t, result
+
+
+def bench_load(years=(1, 10, 40), timezone='Europe/Paris'):
+    tmp = tempfile.mkdtemp()
+    try:
+        for y in years:
+            path = write_septo3d_file(os.path.join(tmp, 'meteo%d.txt' % y), y)
+            t, weather = timeit(Weather, path, timezone=timezone)
+            print('load %2d years (%d rows): %.2f s' % (y, len(weather.data),
+                                                       t))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_window(years=10, requests=100000, hours=24):
+    weather = synthetic_weather(periods=years * 8760)
+    index = weather.data.index
+    rng = numpy.random.RandomState(0)
+    starts = rng.randint(0, len(index) - hours, requests)
+    seqs = [index[i:i + hours] for i in starts]
+
+    def truncate():
+        for seq in seqs:
+            weather.data.truncate(before=seq[0], after=seq[-1])
+
+    def get_weather():
+        for seq in seqs:
+            weather.get_weather(seq)
+
+    def get_arrays():
+        for seq in seqs:
+            weather.get_arrays(seq, ['temperature_air', 'rain'])
+
+    print('%d windows of %d hours on %d years:' % (requests, hours, years))
+    for f in (truncate, get_weather, get_arrays):
+        t, _ = timeit(f)
+        print('    %s: %.2f s' % (f.__name__, t))
+
+def bench_load_many(files=8, years=5, workers=(1, 2, 4, 8)):
+    tmp = tempfile.mkdtemp()
+    try:
+        paths = [write_septo3d_file(os.path.join(tmp, 'meteo%d.txt' % i),
+                                    years) for i in range(files)]
+        print('load %d files of %d years (%d cpus):' % (files, years,
+                                                        os.cpu_count()))
+        for n in workers:
+            t, _ = timeit(Weather.load_many, paths, workers=n)
+            print('    %d workers: %.2f s' % (n, t))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    bench_load()
+    bench_window()
+    bench_load_many()
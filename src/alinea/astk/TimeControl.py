@@ -4,11 +4,12 @@ Provides utilities for scheduling models in simulation
 from __future__ import division
 from __future__ import print_function
 from builtins import map
-from builtins import zip
 from builtins import range
 from past.utils import old_div
 from builtins import object
 import numpy
+import pandas
+from datetime import timedelta
 from functools import reduce
 
 class TimeControlSet(object):
@@ -81,9 +82,16 @@ class TimeControler(object):
     
 def evaluation_sequence(delays):
     """ retrieve evaluation filter from sequence of delays
+
+    Return a numpy bool array with one step per unit of delay, True at the
+    first step of each delay
     """
-    seq = [[True if i == 0 else False for i in range(int(d))] for d in delays]
-    return reduce(lambda x,y: x + y, seq)
+    delays = numpy.asarray(delays, dtype='float64').astype('int64')
+    delays = numpy.maximum(delays, 0)
+    seq = numpy.zeros(delays.sum(), dtype=bool)
+    starts = numpy.cumsum(delays) - delays
+    seq[starts[delays > 0]] = True
+    return seq
 
 class EvalValue(object):
     
@@ -100,15 +108,19 @@ class IterWithDelays(object):
     def __init__(self, values = [None], delays = [1]):
         self.delays = delays
         self.values = values
-        self._evalseq = iter(evaluation_sequence(delays))
+        self._evalseq = evaluation_sequence(delays)
+        self._step = 0
         self._iterable = iter(values)
         self._iterdelays = iter(delays)
         
     def __iter__(self):
         return IterWithDelays(self.values, self.delays)
-        
+
     def __next__(self):
-        self.ev = next(self._evalseq)
+        if self._step >= len(self._evalseq):
+            raise StopIteration
+        self.ev = bool(self._evalseq[self._step])
+        self._step += 1
         if self.ev : 
             try: #prevent value exhaustion to stop iterating
                 self.val = next(self._iterable)
@@ -118,12 +130,78 @@ class IterWithDelays(object):
         return EvalValue(self.ev, self.val, self.dt)
 
 
-def _truncdata(data, before, after, last):
-    d = data.truncate(before = before, after = after)
-    if after.to_datetime() < last.to_datetime():
-        d = d.ix[:-1,]
-    return d
-        
+class WindowIndex(object):
+    """ Positions of a sequence of time windows in a date-indexed dataframe
+
+    Window i is data.iloc[starts[i]:stops[i]]. Windows are views on data and
+    per-window reductions are computed with segmented (reduceat) operations
+    """
+
+    def __init__(self, data, starts, stops, dates=None):
+        self.data = data
+        self.starts = numpy.asarray(starts, dtype='int64')
+        self.stops = numpy.maximum(self.starts,
+                                   numpy.asarray(stops, dtype='int64'))
+        if dates is None:
+            dates = data.index[numpy.minimum(self.starts, len(data) - 1)]
+        self.dates = dates
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return self.data.iloc[self.starts[i]:self.stops[i]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def counts(self):
+        """ number of rows of each window """
+        return self.stops - self.starts
+
+    def reduce(self, how='sum', varnames=None):
+        """ Return a dataframe (windows x variables) of the reduction of each
+        window. how is one of 'sum', 'mean', 'min' or 'max'. As with pandas
+        resample, NaN values are skipped, windows without values give 0 for
+        sum and NaN otherwise.
+        """
+        if varnames is None:
+            varnames = self.data.select_dtypes(include=[numpy.number]).columns
+        values = self.data.loc[:, varnames].values.astype('float64')
+        # padding row allows stops == len(data) as reduceat indices
+        values = numpy.vstack([values, numpy.zeros((1, values.shape[1]))])
+        valid = ~numpy.isnan(values)
+        bounds = numpy.column_stack([self.starts, self.stops]).ravel()
+        counts = numpy.add.reduceat(valid.astype('int64'), bounds, axis=0)[::2]
+        counts[self.counts() == 0] = 0
+        if how in ('sum', 'mean'):
+            result = numpy.add.reduceat(numpy.where(valid, values, 0), bounds,
+                                        axis=0)[::2]
+            if how == 'mean':
+                with numpy.errstate(invalid='ignore', divide='ignore'):
+                    result = result / counts
+        else:
+            ufunc = {'min': numpy.fmin, 'max': numpy.fmax}[how]
+            result = ufunc.reduceat(values, bounds, axis=0)[::2]
+        if how == 'sum':
+            result[counts == 0] = 0
+        else:
+            result[counts == 0] = numpy.nan
+        return pandas.DataFrame(result, index=self.dates, columns=varnames)
+
+
+def window_index(data, firsts, lasts):
+    """ WindowIndex of windows starting at dates firsts and ending at dates lasts
+    (included), located in one searchsorted pass on the nanosecond index of data
+    """
+    firsts = pandas.DatetimeIndex(firsts)
+    index = data.index.asi8
+    starts = numpy.searchsorted(index, firsts.asi8, side='left')
+    stops = numpy.searchsorted(index, pandas.DatetimeIndex(lasts).asi8,
+                               side='right')
+    return WindowIndex(data, starts, stops, dates=firsts)
+
+
 def time_control(time_sequence, eval_filter, data=None):
     """ Produces controls for multi-delay or weather dependant models 
     return splited weather data (if given) and delays
@@ -135,20 +213,45 @@ def time_control(time_sequence, eval_filter, data=None):
     - `eval_filter` a list (same length as time_sequence) of bools indicating the steps at which an evaluation is needed
     - `data` (panda dataframe indexed by date)
         data for the model   
+
+    Values are a WindowIndex of views on data, from each evaluation date
+    to the next one (excluded), the last window ending at the last date of
+    time_sequence (included). Window bounds are located in one searchsorted
+    pass (naive dates are interpreted as UTC). Delays (hours) are a numpy array.
     """
-    
-    starts = time_sequence[eval_filter]
-    ends = starts[1:].tolist() + [time_sequence[-1]]
-    last = time_sequence[-1]
-    if data is not None:
-        controls = [(old_div((end - start).total_seconds(), 3600), _truncdata(data, start, end, last)) for start,end in zip(starts,ends)]
-    else:
-        controls = [(old_div((end - start).total_seconds(), 3600), None) for start,end in zip(starts,ends)]
-    delays, values = list(zip(*controls))
-    return values, delays
+    time_sequence = pandas.DatetimeIndex(time_sequence)
+    evaluated = numpy.asarray(eval_filter, dtype=bool)
+    dates = time_sequence.asi8
+    starts = dates[evaluated]
+    ends = numpy.append(starts[1:], dates[-1:])
+    delays = (ends - starts) / 3.6e12
+    if data is None:
+        return [None] * len(starts), delays
+    index = data.index.asi8
+    first = numpy.searchsorted(index, starts, side='left')
+    stop = numpy.searchsorted(index, ends, side='left')
+    if len(stop):
+        stop[-1] = numpy.searchsorted(index, ends[-1], side='right')
+    return WindowIndex(data, first, stop, dates=time_sequence[evaluated]), \
+        delays
  
   
   
+def _nanoseconds(delay):
+    """ duration in nanoseconds of a delay given in hours or as a timedelta """
+    if isinstance(delay, (str, timedelta)):
+        return pandas.Timedelta(delay).value
+    return int(round(delay * 3600 * 10 ** 9))
+
+
+def utc_index(dates):
+    """ UTC DatetimeIndex of dates (naive dates are interpreted as UTC) """
+    dates = pandas.DatetimeIndex(dates)
+    if dates.tz is None:
+        return dates.tz_localize('UTC')
+    return dates.tz_convert('UTC')
+
+
 def time_filter(time_sequence, delay = 1):
     """ return an evaluation filter being True at regular period
     
@@ -157,32 +260,94 @@ def time_filter(time_sequence, delay = 1):
     - `time_sequence` (panda dateTime index)
         A sequence of TimeStamps indicating the dates of all elementary time steps of the simulation
     - `delay` (int)
-        The duration of each period
+        The duration of each period, in hours (possibly fractional, eg 0.25) or
+        as a timedelta string (eg '15min', '2D')
 
+    The filter is a numpy bool array computed by integer modulo on nanoseconds
     """
-    
-    time = [old_div((t - time_sequence[0]).total_seconds(), 3600) for t in time_sequence]
-    filter = [t % delay == 0 for t in time]
-    return filter
+    period = _nanoseconds(delay)
+    if period <= 0:
+        raise ValueError('delay should be positive')
+    dates = pandas.DatetimeIndex(time_sequence).asi8
+    return (dates - dates[:1]) % period == 0
 
 def time_filter_node(time_sequence, delay = 1):
     filter = time_filter(time_sequence, delay)
     return time_sequence, filter
 #time_filter_node.__doc__ = time_filter.__doc__
 
-def date_filter(time_sequence, time_data):
+def date_filter(time_sequence, time_data, tolerance=None):
     """
     Return evaluation filter being True at date in time_data
    - time_data : a datetimle indexed panda dataframe
+   - tolerance : if not None, each date of time_data is snapped to the
+    nearest step of time_sequence, if not further than tolerance (hours or
+    timedelta string, eg '30min'). Otherwise dates should match exactly.
+
+    Dates are compared as int64 UTC nanoseconds (naive dates are interpreted
+    as UTC) and time_sequence is expected sorted. The filter is a numpy bool
+    array.
     """
-    
-    filter = [True if d.to_datetime() in time_data.index.to_datetime() else False for d in time_sequence]
+    dates = utc_index(time_sequence).asi8
+    index = getattr(time_data, 'index', time_data)
+    events = utc_index(index).asi8
+    filter = numpy.zeros(len(dates), dtype=bool)
+    if len(dates) == 0 or len(events) == 0:
+        return filter
+    after = numpy.clip(numpy.searchsorted(dates, events), 0, len(dates) - 1)
+    before = numpy.maximum(after - 1, 0)
+    nearest = numpy.where(numpy.abs(dates[before] - events) <=
+                          numpy.abs(dates[after] - events), before, after)
+    tolerance = 0 if tolerance is None else _nanoseconds(tolerance)
+    close = numpy.abs(dates[nearest] - events) <= tolerance
+    filter[nearest[close]] = True
     return filter
     
 def date_filter_node(time_sequence, time_data):
     filter = date_filter(time_sequence, time_data)
     return time_sequence, filter, time_data
     
+def rain_events(time_sequence, weather, rain_min = 0.2):
+    """ return the table of rain events occuring during time_sequence
+
+    :Parameters:
+    ----------
+    - `time_sequence` (panda dateTime index)
+        A sequence of TimeStamps indicating the dates  of all elementary time steps of the simulation
+    - `weather` (weather instance)
+        weather database (should contain rain column)
+    - `rain_min` steps with rain (mm) above rain_min are rainy
+
+    Return a dataframe with one row per event (run of rainy steps) and columns:
+    start and end (dates of the first and last rainy steps), duration (hours,
+    from start to the end of the last step), total (mm) and peak (maximal rain
+    of one step, mm)
+    """
+    time_sequence = pandas.DatetimeIndex(time_sequence)
+    dates = utc_index(time_sequence).asi8
+    index = utc_index(weather.data.index).asi8
+    positions = numpy.minimum(numpy.searchsorted(index, dates), len(index) - 1)
+    if len(index) == 0 or (index[positions] != dates).any():
+        raise KeyError('rain is missing for some dates of time_sequence')
+    rain = weather.data['rain'].values[positions].astype('float64')
+    wet = rain > rain_min
+    rain = numpy.where(wet, rain, 0)
+    # run-length encoding of the rainy steps
+    changes = numpy.diff(numpy.concatenate([[0], wet.astype('int8'), [0]]))
+    starts = numpy.nonzero(changes == 1)[0]
+    stops = numpy.nonzero(changes == -1)[0]
+    cumulated = numpy.concatenate([[0], numpy.cumsum(rain)])
+    step = dates[-1] - dates[-2] if len(dates) > 1 else 3600 * 10 ** 9
+    ends = numpy.append(dates, dates[-1:] + step)
+    return pandas.DataFrame(
+        {'start': time_sequence[starts], 'end': time_sequence[stops - 1],
+         'duration': (ends[stops] - dates[starts]) / 3.6e12,
+         'total': cumulated[stops] - cumulated[starts],
+         'peak': numpy.maximum.reduceat(rain, starts) if len(starts) else
+         numpy.zeros(0)},
+        columns=['start', 'end', 'duration', 'total', 'peak'])
+
+
 def rain_filter(time_sequence, weather, rain_min = 0.2):
     """ return an evaluation filter iterating every rain event and every  between-rain event
     
@@ -192,17 +357,17 @@ def rain_filter(time_sequence, weather, rain_min = 0.2):
         A sequence of TimeStamps indicating the dates  of all elementary time steps of the simulation
     - `weather` (weather instance)
         weather database (should contain rain column) 
+
+    The filter is a numpy bool array, True at the first step, at the start of
+    every rain event and at the step following its end (see rain_events)
     """
-    try:
-        rain = weather.data.rain[time_sequence]
-    except:
-        #strange extract needed on visualea 1.0 (to test again with ipython in visualea)
-        rain_data = weather.data[['rain']]
-        rain = numpy.array([float(rain_data.loc[d]) for d in time_sequence])
-    #rain = weather_data.rain[time_sequence]   
-    rain[rain <= rain_min] = 0
-    rain[rain > 0] = 1
-    filter = [True] +(rain[1:] != rain[:-1]).tolist()
+    events = rain_events(time_sequence, weather, rain_min)
+    dates = utc_index(time_sequence).asi8
+    filter = numpy.zeros(len(dates), dtype=bool)
+    filter[:1] = True
+    filter[numpy.searchsorted(dates, utc_index(events['start']).asi8)] = True
+    after = numpy.searchsorted(dates, utc_index(events['end']).asi8) + 1
+    filter[after[after < len(dates)]] = True
     return filter
     
 def rain_filter_node(time_sequence, weather):
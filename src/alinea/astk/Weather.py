@@ -11,33 +11,39 @@ from builtins import str
 from builtins import range
 from builtins import object
 from past.utils import old_div
+import inspect
+import os
+import numpy
 import pandas
 import pytz
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from datetime import timedelta
 
 
 from alinea.astk.TimeControl import *
 from alinea.astk.meteorology.sun_position import sun_position
+from alinea.astk.meteorology.sky_irradiance import clear_sky_irradiances
+from alinea.astk.meteorology.sun_position_astk import daylength
 import alinea.astk.sun_and_sky as sunsky
-
-
-def septo3d_reader(data_file):
-    """ reader for septo3D meteo files """
-
-    def parse(yr, doy, hr):
-        """ Convert the 'An', 'Jour' and 'hhmm' variables of the
-        meteo dataframe in a datetime object (%Y-%m-%d %H:%M:%S format)
-        """
-        an, jour, heure = [int(x) for x in [yr, doy, old_div(int(hr), 100)]]
-        dt = datetime(an - 1, 12, 31)
-        delta = timedelta(days=jour, hours=heure)
-        return dt + delta
-
-    data = pandas.read_csv(data_file,
-                           parse_dates={'date': ['An', 'Jour', 'hhmm']},
-                           date_parser=parse, sep='\t')
-    # ,
-    # usecols=['An','Jour','hhmm','PAR','Tair','HR','Vent','Pluie'])
+from alinea.astk.weather_cache import cache_path, write_cache, read_cache
+from alinea.astk.weather_qc import quality_control
+from alinea.astk.weather_shared import to_shared_memory, \
+    from_shared_memory, load_worker, attach, unlink_layout
+
+
+def _septo3d_format(data):
+    """ format a raw septo3D meteo table """
+
+    # Convert the 'An', 'Jour' and 'hhmm' variables of the meteo dataframe in
+    # datetime (%Y-%m-%d %H:%M:%S format), as year + day of year + hour
+    # offsets computed on whole columns
+    year = data['An'].values.astype('int64') - 1970
+    day = data['Jour'].values.astype('int64') - 1
+    hour = data['hhmm'].values.astype('int64') // 100
+    date = (year.astype('datetime64[Y]').astype('datetime64[h]') +
+            (day * 24 + hour).astype('timedelta64[h]'))
+    data = data.drop(['An', 'Jour', 'hhmm'], axis=1)
+    data.insert(0, 'date', date.astype('datetime64[ns]'))
 
     data.index = data.date
     data = data.rename(columns={'PAR': 'PPFD', 'Tair': 'temperature_air',
@@ -46,22 +52,130 @@ def septo3d_reader(data_file):
     return data
 
 
-def PPFD_to_global(data):
+def septo3d_reader(data_file, chunksize=None):
+    """ reader for septo3D meteo files
+
+    If chunksize is given, an iterator on successive dataframes of chunksize
+    rows is returned instead of a single dataframe
+    """
+
+    # ,
+    # usecols=['An','Jour','hhmm','PAR','Tair','HR','Vent','Pluie'])
+    if chunksize is None:
+        return _septo3d_format(pandas.read_csv(data_file, sep='\t'))
+    chunks = pandas.read_csv(data_file, sep='\t', chunksize=chunksize)
+    return (_septo3d_format(chunk) for chunk in chunks)
+
+
+def localise(data, timezone, ambiguous='dst', nonexistent='1h'):
+    """ index data with utc dates, interpreting its 'date' column in timezone
+
+    - ambiguous is the policy for local hours repeated when DST ends :
+    'dst' (default, as pytz localize of the reader timestamps) interprets them
+    as summer time, 'standard' as winter time. Other values ('infer', 'NaT', 'raise' or a bool
+    array) are passed to pandas tz_localize.
+    - nonexistent is the policy for local hours skipped when DST starts : a
+    timedelta string (default '1h', ie shift forward by one hour) or one of
+    pandas tz_localize options ('shift_forward', 'shift_backward', 'NaT',
+    'raise')
+    """
+    date = pandas.DatetimeIndex(data['date'])
+    if ambiguous in ('dst', 'standard'):
+        ambiguous = numpy.full(len(date), ambiguous == 'dst')
+    if isinstance(nonexistent, str) and nonexistent not in (
+            'shift_forward', 'shift_backward', 'NaT', 'raise'):
+        nonexistent = pandas.Timedelta(nonexistent)
+    utc = date.tz_localize(timezone, ambiguous=ambiguous,
+                           nonexistent=nonexistent).tz_convert('UTC')
+    data.index = utc
+    data.index.name = 'date_utc'
+    return data
+
+
+def to_compact(data):
+    """ drop the redundant 'date' column of data and store its numerical
+    variables as float32
+
+    float32 keeps about 7 significant digits: measured values and
+    conversions are preserved up to a relative error of 1e-6.
+    """
+    if 'date' in data.columns:
+        data = data.drop('date', axis=1)
+    numerical = data.select_dtypes(include=[numpy.number]).columns
+    return data.astype(dict((c, 'float32') for c in numerical))
+
+
+# linear conversions between variables: (source, target) -> scale factor
+# (PPFD in micromol.m-2.s-1, PAR, NIR and global_radiation in W.m-2)
+unit_conversions = {}
+
+
+def register_conversion(source, target, factor):
+    """ Register the linear conversion target = factor * source, and its
+    inverse
+    """
+    unit_conversions[(source, target)] = factor
+    unit_conversions[(target, source)] = 1. / factor
+
+
+# 1 WattsPAR.m-2 = 4.6 ppfd, 1 Wglobal = 0.48 WattsPAR + 0.52 WattsNIR
+register_conversion('PAR', 'PPFD', 4.6)
+register_conversion('global_radiation', 'PAR', 0.48)
+register_conversion('global_radiation', 'NIR', 0.52)
+
+
+def conversion_factor(source, target):
+    """ Scale factor converting source into target, chaining registered
+    conversions. None if target cannot be obtained from source
+    """
+    factors = {source: 1.}
+    queue = [source]
+    while queue:
+        v = queue.pop(0)
+        if v == target:
+            return factors[v]
+        for (s, t), f in unit_conversions.items():
+            if s == v and t not in factors:
+                factors[t] = factors[v] * f
+                queue.append(t)
+    return None
+
+
+def convert(data, source, target, out=None):
+    """ Convert column source of data into target in one pass
+
+    Chained conversions (eg PPFD -> global_radiation -> NIR) are fused in a
+    single scale factor. Values are read from the column without copy and
+    written in out if given (an array of the length of data)
+    """
+    factor = conversion_factor(source, target)
+    if factor is None:
+        raise ValueError('no conversion from ' + source + ' to ' + target)
+    return numpy.multiply(data[source].values, factor, out=out)
+
+
+def conversion_model(source, target):
+    """ A weather model computing target from source (see convert)
+    """
+    def model(data, out=None):
+        return convert(data, source, target, out=out)
+    return model
+
+
+def PPFD_to_global(data, out=None):
     """ Convert the PAR (ppfd in micromol.m-2.sec-1)
     in global radiation (J.m-2.s-1, ie W/m2)
     1 WattsPAR.m-2 = 4.6 ppfd, 1 Wglobal = 0.48 WattsPAR)
     """
-    PAR = data[['PPFD']].values
-    return (PAR * 1. / 4.6) / 0.48
+    return convert(data, 'PPFD', 'global_radiation', out=out)
 
 
-def global_to_PPFD(data):
+def global_to_PPFD(data, out=None):
     """ Convert the global radiation (J.m-2.s-1, ie W/m2)
     in PAR (ppfd in micromol.m-2.sec-1)
     1 WattsPAR.m-2 = 4.6 ppfd, 1 Wglobal = 0.48 WattsPAR)
     """
-    Rg = data[['global_radiation']].values
-    return Rg * 0.48 * 4.6
+    return convert(data, 'global_radiation', 'PPFD', out=out)
 
 
 def Psat(T):
@@ -70,16 +184,24 @@ def Psat(T):
     return 0.6108 * numpy.exp(old_div(17.27 * T, (237.3 + T)))
 
 
-def humidity_to_vapor_pressure(data):
+def humidity_to_vapor_pressure(data, out=None):
     """ Convert the relative humidity (%) in water vapor pressure (kPa)
     """
-    humidity = data[['relative_humidity']].values
-    Tair = data[['temperature_air']].values
-    return humidity / 100. * Psat(Tair)
+    humidity = data['relative_humidity'].values
+    Tair = data['temperature_air'].values
+    # Psat(Tair) * humidity / 100, computed in place in out
+    out = numpy.add(Tair, 237.3, out=out)
+    numpy.divide(Tair, out, out=out)
+    out *= 17.27
+    numpy.exp(out, out=out)
+    out *= 0.6108 / 100.
+    out *= humidity
+    return out
 
 
 def linear_degree_days(data, start_date=None, base_temp=0., max_temp=35.):
-    df = data['temperature_air'].copy()
+    # accumulation is done in float64, even for compact (float32) data
+    df = data['temperature_air'].astype('float64')
     if start_date is None:
         start_date = data.index[0]
     df[df < base_temp] = 0.
@@ -90,6 +212,43 @@ def linear_degree_days(data, start_date=None, base_temp=0., max_temp=35.):
     return dd - dd[df.index.searchsorted(start_date)]
 
 
+# registry of the default models used by Weather.check:
+# variable name: (model, list of variables the model reads in data)
+weather_models = {'global_radiation': (PPFD_to_global, ['PPFD']),
+                  'vapor_pressure': (humidity_to_vapor_pressure,
+                                     ['relative_humidity', 'temperature_air']),
+                  'PPFD': (global_to_PPFD, ['global_radiation']),
+                  'degree_days': (linear_degree_days, ['temperature_air'])}
+
+
+# aggregation rules of variables for Weather.at_resolution (default is 'mean')
+resample_rules = {'rain': 'sum', 'PPFD': 'sum', 'global_radiation': 'sum',
+                  'temperature_air': 'mean', 'degree_days': 'max'}
+
+
+# models accumulating values over time: Weather.append carries their last
+# value forward instead of restarting them
+cumulative_models = set([linear_degree_days])
+
+
+def register_model(name, model, inputs=(), cumulative=False):
+    """ Register model as the default model computing variable name from
+    the variables listed in inputs. cumulative models return values
+    accumulated since the first date of data (eg degree days)
+    """
+    weather_models[name] = (model, list(inputs))
+    if cumulative:
+        cumulative_models.add(model)
+
+
+def _as_model(model):
+    """ (model, inputs) tuple of a registered or plain (without declared
+    inputs) model """
+    if callable(model):
+        return model, []
+    return model[0], list(model[1])
+
+
 class Weather(object):
     """ Class compliying echap local_microclimate model protocol (meteo_reader).
         expected variables of the data_file are:
@@ -103,34 +262,326 @@ class Weather(object):
             - 'Vent' : Wind speed (m.s-1)
         - localisation is a {'name':city, 'lontitude':lont, 'latitude':lat} dict
         - timezone indicates the standard timezone name (see pytz infos) to be used for interpreting the date (default 'UTC')
+        - ambiguous and nonexistent are the policies for dates repeated or skipped at DST changes (see localise)
+        - qc controls the quality control of data at load time: False (default) for no control, True or a dict of
+        quality_control keywords otherwise. Flags of controlled values are then stored in qc_flags.
+        - compact: if True, the 'date' column is dropped (dates remain available as the UTC index of data) and
+        numerical variables are stored as float32 (see to_compact). Default False.
+        - cache_dir is an optional directory where the parsed data (and the variables later added by check) are cached.
+        The cache is invalidated if the data_file, the reader or the timezone change. (default None, no cache)
+        Assigning data (or appending rows) detaches the instance from its cache file.
+
+        Variables created by check are computed lazily, when they are first accessed, and are recomputed if one of their
+        inputs is modified with set_variable. Only set_variable invalidates them: assigning a column of data directly
+        (eg weather.data['PPFD'] = ...) does not recompute global_radiation.
     """
 
     def __init__(self, data_file='', reader=septo3d_reader, wind_screen=2,
                  temperature_screen=2,
                  localisation={'city': 'Montpellier', 'latitude': 43.61,
                                'longitude': 3.87},
-                 timezone='UTC'):
+                 timezone='UTC', cache_dir=None, ambiguous='dst',
+                 nonexistent='1h', qc=False, compact=False):
         self.data_path = data_file
-        self.models = {'global_radiation': PPFD_to_global,
-                       'vapor_pressure': humidity_to_vapor_pressure,
-                       'PPFD': global_to_PPFD,
-                       'degree_days': linear_degree_days}
+        self.cache_file = None
+        self.qc_flags = None
+        self.models = dict(weather_models)
+        self.ambiguous = ambiguous
+        self.nonexistent = nonexistent
+        self.qc = qc
+        self.compact = compact
+        # daylength lookup tables: (latitude, year, elevation) -> array
+        self._daylengths = {}
+        # shared memory blocks created by to_shared
+        self._shm = []
 
         self.timezone = pytz.timezone(timezone)
         if data_file is '':
             self.data = None
         else:
-            self.data = reader(data_file)
-            date = self.data['date']
-            date = [self.timezone.localize(x) for x in date]
-            utc = [x.astimezone(pytz.utc) for x in date]
-            self.data.index = utc
-            self.data.index.name = 'date_utc'
+            cache_file = None
+            if cache_dir is not None:
+                options = (str(ambiguous), str(nonexistent), repr(qc),
+                           compact)
+                cache_file = cache_path(data_file, cache_dir, reader,
+                                        timezone, options)
+            if cache_file is not None and os.path.exists(cache_file):
+                self.data, derived = read_cache(cache_file, with_derived=True)
+                self._cached = set(self._data.columns)
+                for name in derived:
+                    model, inputs = weather_models[name]
+                    self._derived[name] = (model, inputs, {})
+                if qc:
+                    self.qc_flags = read_cache(cache_file + '.qc.npz')
+            else:
+                data = localise(reader(data_file), self.timezone, ambiguous,
+                                nonexistent)
+                if qc:
+                    data, self.qc_flags = quality_control(
+                        data, **(qc if isinstance(qc, dict) else {}))
+                if compact:
+                    data = to_compact(data)
+                self.data = data
+                if cache_file is not None:
+                    write_cache(cache_file, self.data)
+                    self._cached = set(self._data.columns)
+                    if qc:
+                        write_cache(cache_file + '.qc.npz', self.qc_flags)
+            # set after data, as assigning data detaches the cache file
+            self.cache_file = cache_file
 
         self.wind_screen = wind_screen
         self.temperature_screen = temperature_screen
         self.localisation = localisation
 
+    @property
+    def data(self):
+        """ the weather dataframe, with all variables declared by check """
+        if self._pending:
+            for v in list(self._pending):
+                self._compute(v)
+            if self.cache_file is not None:
+                self._write_cache()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        # the new data is not the content of the cache file
+        self.cache_file = None
+        self._data = data
+        # derived variables: name -> (model, inputs, args), pending ones in
+        # declaration order (inputs first)
+        self._pending = OrderedDict()
+        self._derived = {}
+        self._resolutions = {}
+        self._sun = None
+        # columns stored in the cache file, columns set by set_variable
+        self._cached = set()
+        self._modified = set()
+
+    def _cacheable(self, name):
+        """ True if column name is measured (and not modified) or derived with
+        its default model and default args from cacheable columns """
+        if name in self._modified:
+            return False
+        if name not in self._derived:
+            return True
+        model, inputs, args = self._derived[name]
+        default = weather_models.get(name)
+        return default is not None and model is default[0] and not args and \
+            all(self._cacheable(v) for v in inputs)
+
+    def _write_cache(self):
+        """ add new cacheable derived columns to the cache file """
+        new = [c for c in self._derived if c not in self._cached and
+               self._cacheable(c)]
+        if not new:
+            return
+        if os.path.exists(self.cache_file):
+            cached, derived = read_cache(self.cache_file, with_derived=True)
+        else:
+            # cache file removed: rewrite all cacheable columns
+            columns = [c for c in self._data.columns if self._cacheable(c)]
+            cached = self._data.loc[:, [c for c in columns if c not in new]]
+            derived = [c for c in cached.columns if c in self._derived]
+        for c in new:
+            cached[c] = self._data[c].values
+        write_cache(self.cache_file, cached, derived=derived + new)
+        self._cached = set(cached.columns)
+
+    def _compute(self, name, visiting=()):
+        """ compute a pending variable and its pending inputs. Models without
+        declared inputs (plain callables) may use any variable declared
+        before them, which are computed first """
+        if name not in self._pending or name in visiting:
+            return
+        model, inputs, args = self._pending[name]
+        needed = inputs
+        if not inputs:
+            declared = list(self._pending)
+            needed = declared[:declared.index(name)]
+        for v in needed:
+            self._compute(v, visiting + (name,))
+        try:
+            values = model(self._data, **args)
+        except Exception:
+            # a failing model is reported once, data remains usable
+            del self._pending[name]
+            raise
+        self._data[name] = values
+        del self._pending[name]
+        self._derived[name] = (model, inputs, args)
+
+    def _resolvable(self, name, models, visiting=()):
+        """ True if name is present or can be computed with models """
+        if name in self._data.columns or name in self._pending:
+            return True
+        if name not in models or name in visiting:
+            return False
+        _, inputs = models[name]
+        return all(self._resolvable(v, models, visiting + (name,)) for v in
+                   inputs)
+
+    def _declare(self, name, models, args):
+        """ declare name and its missing inputs as pending variables """
+        if name in self._data.columns or name in self._pending:
+            return
+        model, inputs = models[name]
+        for v in inputs:
+            self._declare(v, models, args)
+        self._pending[name] = (model, inputs, args.get(name, {}))
+
+    def _conversion_source(self, name):
+        """ a present or pending variable that can be converted into name """
+        for v in list(self._data.columns) + list(self._pending):
+            if v != name and conversion_factor(v, name) is not None:
+                return v
+        return None
+
+    def variable(self, what):
+        """ Return the column what of data, computing it if needed
+        """
+        self._compute(what)
+        return self._data[what]
+
+    def set_variable(self, what, values):
+        """ Set column what of data. Derived variables depending on what are
+        discarded and will be recomputed when accessed (which does not happen
+        when columns of data are assigned directly).
+
+        Values set (and variables derived from them) are not written to the
+        cache file.
+        """
+        self._pending.pop(what, None)
+        self._derived.pop(what, None)
+        self._modified.add(what)
+        self._data[what] = values
+        self._invalidate(what)
+
+    def _invalidate(self, what):
+        """ move derived variables depending on what back to pending """
+        self._resolutions = {}
+        stale = [what]
+        while stale:
+            v = stale.pop()
+            for name, (model, inputs, args) in list(self._derived.items()):
+                if v in inputs:
+                    del self._derived[name]
+                    del self._data[name]
+                    self._pending[name] = (model, inputs, args)
+                    stale.append(name)
+
+    def append(self, rows):
+        """ Append new time steps to data, eg from a live weather feed
+
+        rows is a dataframe in the format of the reader (with a local 'date'
+        column, localised as data) or indexed by dates (naive dates are UTC).
+        In the latter case, the 'date' column of data, if any, is filled with
+        the local dates of the index. Its dates should all be posterior to the
+        last date of data.
+
+        Derived variables are computed for the new rows only, cumulative ones
+        (see cumulative_models) continuing from their last value. The cached
+        sun geometry is extended, aggregations by at_resolution are discarded.
+        The cache file, if any, is not updated.
+        """
+        rows = rows.copy()
+        if 'date' in rows.columns:
+            rows = localise(rows, self.timezone, self.ambiguous,
+                            self.nonexistent)
+        else:
+            rows.index = utc_index(rows.index)
+            rows.index.name = 'date_utc'
+            if self._data is not None and 'date' in self._data.columns:
+                rows['date'] = rows.index.tz_convert(
+                    self.timezone).tz_localize(None)
+        if len(rows) == 0:
+            return
+        if not rows.index.is_monotonic_increasing:
+            rows = rows.sort_index()
+        data = self._data
+        if data is not None and len(data) > 0 and rows.index[0] <= \
+                data.index[-1]:
+            raise ValueError('appended dates should be posterior to ' +
+                             str(data.index[-1]))
+        if self.qc:
+            rows, flags = quality_control(
+                rows, **(self.qc if isinstance(self.qc, dict) else {}))
+        if self.compact:
+            rows = to_compact(rows)
+
+        if data is None or len(data) == 0:
+            self._data = rows
+        else:
+            # derived variables are in computation order
+            for name, (model, inputs, args) in self._derived.items():
+                if model in cumulative_models:
+                    context = pandas.concat([data.iloc[-1:], rows], sort=False)
+                    values = numpy.ravel(model(context, **args))
+                    rows[name] = data[name].values[-1] + (values[1:] -
+                                                          values[0])
+                else:
+                    rows[name] = numpy.ravel(model(rows, **args))
+            columns = list(data.columns) + [c for c in rows.columns if
+                                            c not in data.columns]
+            self._data = pandas.concat([data, rows], sort=False).loc[:,
+                                                                     columns]
+            if self._sun is not None:
+                self._sun = pandas.concat([self._sun,
+                                           self._sun_geometry(rows.index)])
+        if self.qc:
+            if self.qc_flags is None:
+                self.qc_flags = flags
+            else:
+                self.qc_flags = pandas.concat([self.qc_flags, flags],
+                                              sort=False).fillna(0).astype(
+                    'uint8')
+        self._resolutions = {}
+        self.cache_file = None
+
+    def _tail(self):
+        """ a Weather holding the last row of data, with cumulative variables
+        computed """
+        for name, (model, inputs, args) in list(self._pending.items()):
+            if model in cumulative_models:
+                self._compute(name)
+        tail = Weather()
+        tail.data = self._data.iloc[-1:].copy()
+        tail._derived = dict(self._derived)
+        return tail
+
+    def _continue_cumulative(self, previous):
+        """ compute pending cumulative variables (see cumulative_models) as
+        continuations of their values in previous, a Weather whose data
+        precedes data """
+        for name, (model, inputs, args) in list(self._pending.items()):
+            if model not in cumulative_models or name not in set(
+                    previous._derived) | set(previous._pending):
+                continue
+            for v in inputs:
+                self._compute(v)
+            last = pandas.DataFrame(
+                dict((v, previous.variable(v).values[-1:]) for v in inputs),
+                index=previous._data.index[-1:])
+            context = pandas.concat([last, self._data.loc[:, inputs]])
+            values = numpy.ravel(model(context, **args))
+            self._data[name] = previous.variable(name).values[-1] + (
+                values[1:] - values[0])
+            del self._pending[name]
+            self._derived[name] = (model, inputs, args)
+
+    def _take_cumulative(self, whole, start):
+        """ set pending cumulative variables to their values in whole, a
+        Weather whose data contains data from position start """
+        stop = start + len(self._data)
+        for name, (model, inputs, args) in list(self._pending.items()):
+            if model not in cumulative_models or name not in set(
+                    whole._derived) | set(whole._pending):
+                continue
+            self._data[name] = whole.variable(name).values[start:stop]
+            del self._pending[name]
+            self._derived[name] = (model, inputs, args)
+
     def date_range_index(self, start, end=None, by=24):
         """ return a (list of) time sequence that allow indexing one or several time intervals between start and end every 'by' hours
         if end is None, only one time interval of 'by' hours is returned
@@ -148,26 +599,53 @@ class Weather(object):
             bins = pandas.date_range(start=start, end=end, freq=str(by) + 'H',
                                      tz=self.timezone.zone)
             bins = bins.tz_convert('UTC')
-            return [seq[(seq >= bins[i]) & (seq < bins[i + 1])] for i in
+            offsets = seq.searchsorted(bins)
+            return [seq[offsets[i]:offsets[i + 1]] for i in
                     range(len(bins) - 1)]
 
+    def window(self, first, last=None):
+        """ Return the (start, stop) positions of the data between first and
+        last (included) dates. If last is None, last = first.
+
+        Positions are found by binary search on the nanosecond index (naive
+        dates are interpreted as UTC)
+        """
+        if last is None:
+            last = first
+        index = self._data.index.asi8
+        first, last = utc_index([first, last]).asi8
+        start = numpy.searchsorted(index, first, side='left')
+        stop = numpy.searchsorted(index, last, side='right')
+        return int(start), int(max(start, stop))
+
     def get_weather(self, time_sequence):
         """ Return weather data for a given time sequence
         """
-        return self.data.truncate(before=time_sequence[0],
-                                  after=time_sequence[-1])
+        start, stop = self.window(time_sequence[0], time_sequence[-1])
+        return self.data.iloc[start:stop]
 
     def get_weather_start(self, time_sequence):
         """ Return weather data at start of timesequence
         """
-        return self.data.truncate(before=time_sequence[0],
-                                  after=time_sequence[0])
+        start, stop = self.window(time_sequence[0])
+        return self.data.iloc[start:stop]
+
+    def get_arrays(self, time_sequence, varnames=None):
+        """ Return a {name: array} dict of the values of varnames (default to
+        all columns) between first and last date of time_sequence.
+
+        Arrays are views on data, they should not be modified
+        """
+        start, stop = self.window(time_sequence[0], time_sequence[-1])
+        if varnames is None:
+            varnames = self.data.columns
+        return dict((v, self.variable(v).values[start:stop]) for v in varnames)
 
     def get_variable(self, what, time_sequence):
         """
         return values of what at date specified in time sequence
         """
-        return self.data[what][time_sequence]
+        return self.variable(what)[time_sequence]
 
     def check(self, varnames=[], models={}, args={}):
         """ Check if varnames are in data and try to create them if absent using defaults models or models provided in arg.
@@ -176,38 +654,173 @@ class Weather(object):
         Parameters: 
         
         - varnames : a list of name of variable to check
-        - models a dict (name: model) of models to use to generate the data. models receive data as argument
+        - models a dict (name: model) of models to use to generate the data. models receive data as argument.
+        Models can be given as (model, inputs) tuples to declare the variables they need (see weather_models).
+        Variables without model are converted from present ones if possible (see unit_conversions).
+        Missing variables are only computed when first accessed. If their model then fails, the error is raised and the
+        variable is dropped (it can be checked again). Once computed, they are only recomputed when one of their inputs
+        is modified with set_variable.
         """
 
-        models.update(self.models)
+        all_models = dict(self.models)
+        all_models.update(models)
+        all_models = dict((k, _as_model(m)) for k, m in all_models.items())
 
         check = []
 
         for v in varnames:
-            if v in self.data.columns:
+            built = self._derived.get(v, self._pending.get(v))
+            if built is not None and v in all_models and (
+                    v in models or v in args) and (
+                    built[0] is not all_models[v][0] or
+                    built[2] != args.get(v, {})):
+                # recompute variables derived with other models or args than
+                # the ones explicitly given
+                if v in self._derived:
+                    del self._derived[v]
+                    del self._data[v]
+                    self._invalidate(v)
+                else:
+                    del self._pending[v]
+            if self._resolvable(v, all_models):
+                self._declare(v, all_models, args)
+                check.append(True)
+            elif self._conversion_source(v) is not None:
+                source = self._conversion_source(v)
+                self._pending[v] = (conversion_model(source, v), [source], {})
                 check.append(True)
             else:
-                if v in list(models.keys()):
-                    values = models[v](self.data, **args.get(v, {}))
-                    self.data[v] = values
-                    check.append(True)
-                else:
-                    check.append(False)
+                check.append(False)
+
         return check
 
+    def windows(self, time_step, t_deb, n_steps):
+        """ return a WindowIndex of n_steps windows of time_step hours starting at t_deb"""
+        firsts = pandas.date_range(t_deb, periods=n_steps,
+                                   freq=str(time_step) + 'H')
+        lasts = firsts + timedelta(hours=time_step - 1)
+        return window_index(self.data, firsts, lasts)
+
+    def at_resolution(self, freq='D', rules={}):
+        """ Return numerical variables of data aggregated over periods of
+        frequency freq (a pandas frequency string), aligned on local time:
+            - fixed durations ('H', '3H', 'D', '2D'...) are counted from local
+            midnight of the first date
+            - calendar periods ('W', 'W-MON', 'M', 'Q', 'A'...), without
+            multiple, are local calendar weeks, months, etc, as in pandas
+            resample and to_period. Periods are labelled by their start.
+
+        rules is a {variable: 'sum' | 'mean' | 'min' | 'max'} dict completing
+        the default resample_rules. Results are cached per frequency, rules
+        and numerical columns. The cache is cleared by set_variable, append
+        and assignment of data, but not by in place modifications of data
+        values (eg weather.data['rain'] = ...), that should be done with
+        set_variable.
+        """
+        data = self.data
+        all_rules = dict(resample_rules)
+        all_rules.update(rules)
+        columns = data.select_dtypes(include=[numpy.number]).columns
+        key = (freq, tuple(columns), tuple(sorted(all_rules.items())))
+        if key not in self._resolutions:
+            offset = pandas.tseries.frequencies.to_offset(freq)
+            local = data.index.tz_convert(self.timezone)
+            if isinstance(offset, pandas.tseries.offsets.Tick):
+                start = local[0].normalize()
+                edges = pandas.date_range(start, local[-1] + offset,
+                                          freq=offset)
+                edges = edges.tz_convert('UTC')
+                offsets = data.index.searchsorted(edges)
+                # drop empty periods before first and after last date
+                first = numpy.searchsorted(offsets, 0, side='right') - 1
+                last = numpy.searchsorted(offsets, len(data), side='left')
+                offsets = offsets[first:last + 1]
+                windows = WindowIndex(data, offsets[:-1], offsets[1:],
+                                      dates=edges[first:last])
+            else:
+                if offset.n != 1:
+                    raise ValueError('multiples of calendar frequencies are '
+                                     'not supported: ' + str(freq))
+                periods = local.tz_localize(None).to_period(offset)
+                ordinals = periods.asi8
+                all_periods = numpy.arange(ordinals[0], ordinals[-1] + 1)
+                dates = pandas.PeriodIndex(ordinal=all_periods,
+                                           freq=periods.freq).start_time
+                dates = dates.tz_localize(
+                    self.timezone, ambiguous=numpy.zeros(len(dates), bool),
+                    nonexistent='shift_forward').tz_convert('UTC')
+                windows = WindowIndex(
+                    data, numpy.searchsorted(ordinals, all_periods, 'left'),
+                    numpy.searchsorted(ordinals, all_periods, 'right'),
+                    dates=dates)
+            how = dict((c, all_rules.get(c, 'mean')) for c in columns)
+            reduced = [windows.reduce(h, [c for c in columns if how[c] == h])
+                       for h in set(how.values())]
+            self._resolutions[key] = pandas.concat(reduced, axis=1).loc[:,
+                                                                        columns]
+        return self._resolutions[key]
+
     def split_weather(self, time_step, t_deb, n_steps):
 
         """ return a list of sub-part of the meteo data, each corresponding to one time-step"""
-        tdeb = pandas.date_range(t_deb, periods=1, freq='H')[0]
-        tstep = [tdeb + i * timedelta(hours=time_step) for i in range(n_steps)]
-        return [self.data.truncate(before=t,
-                                   after=t + timedelta(hours=time_step - 1)) for
-                t in tstep]
+        return list(self.windows(time_step, t_deb, n_steps))
+
+    def sun_geometry(self):
+        """ Return a dataframe of sun elevation, azimuth, zenith (degrees) and
+        clear sky direct horizontal irradiance (W.m-2) at all dates of data.
+
+        It is computed once (day and night) and reused by sun_path and
+        light_sources.
+        """
+        if self._sun is None:
+            self._sun = self._sun_geometry(self._data.index)
+        return self._sun
+
+    def _sun_geometry(self, index):
+        """ sun geometry and clear sky irradiance at dates of index """
+        latitude = self.localisation['latitude']
+        longitude = self.localisation['longitude']
+        # dates may be repeated (eg shifted non-existent local times)
+        dates = index.unique()
+        sun = sun_position(dates, latitude=latitude, longitude=longitude,
+                           filter_night=False)
+        sky = clear_sky_irradiances(dates=dates, latitude=latitude,
+                                    longitude=longitude)
+        irradiance = (sky['ghi'] - sky['dhi']).reindex(dates)
+        sun['irradiance'] = irradiance.fillna(0).values
+        if len(dates) < len(index):
+            sun = sun.iloc[dates.get_indexer(index)]
+        return sun
+
+    def _positions(self, seq):
+        """ positions in data of the dates of seq (first one for repeated
+        dates of data), -1 for dates not in data """
+        index = self._data.index
+        if index.is_unique:
+            return index.get_indexer(seq)
+        first = ~index.duplicated()
+        positions = index[first].get_indexer(seq)
+        return numpy.where(positions < 0, -1,
+                           numpy.flatnonzero(first)[positions])
+
+    def _sun_at(self, seq):
+        """ daytime rows of sun_geometry at dates of seq, None if some dates
+        are not in data """
+        positions = self._positions(seq)
+        if len(positions) == 0 or (positions < 0).any():
+            return None
+        sun = self.sun_geometry().iloc[positions]
+        return sun.loc[sun['elevation'] > 0, :]
 
     def sun_path(self, seq):
         """ Return position of the sun corresponing to a sequence of date
         """
-        return sun_position(seq, timezone='utc')
+        sun = self._sun_at(seq)
+        if sun is None:
+            return sun_position(seq, latitude=self.localisation['latitude'],
+                                longitude=self.localisation['longitude'],
+                                timezone='utc')
+        return sun.loc[:, ['elevation', 'azimuth', 'zenith']]
 
     def light_sources(self, seq, what='global_radiation'):
         """ return direct and diffuse ligh sources representing the sky and the sun
@@ -220,18 +833,317 @@ class Weather(object):
         latitude = self.localisation['latitude']
         longitude = self.localisation['longitude']
         # TO DO set actual sky
-        data = self.data.loc[seq,:]
-        sky_irradiance = data[what].sum()
+        sky_irradiance = self.variable(what).loc[seq].sum()
         sky = sunsky.sky_sources(sky_type='soc', irradiance=sky_irradiance,
                                  dates=seq)
-        sun = sunsky.sun_sources(irradiance=None, dates=seq, latitude=latitude,
-                                 longitude=longitude)
+        sun = self._sun_at(seq)
+        if sun is None:
+            sun = sunsky.sun_sources(irradiance=None, dates=seq,
+                                     latitude=latitude, longitude=longitude)
+        else:
+            sun = (sun['elevation'].values, sun['azimuth'].values,
+                   sun['irradiance'].values)
         return sun, sky
 
-    def daylength(self, seq):
+    def light_sources_batch(self, windows, what='global_radiation'):
+        """ light sources of the sun and the sky for many time windows at once
+
+        windows is a WindowIndex on data (see windows) or a list of time
+        sequences whose dates are all in data. Sun geometry is computed once
+        for all dates (see sun_geometry).
+
+        Returns:
+            sun: elevation, azimuth and irradiance of sun sources as
+            (windows x steps) arrays, steps being the length of the longest
+            window. Night steps and padding of shorter windows have nan
+            elevation and azimuth and zero irradiance: the sources of window i
+            are the ones of light_sources(windows[i]).
+            sky: elevation, azimuth of sky sources and (windows x sources)
+            array of irradiance, with sky irradiance of each window equal to
+            the sum of what over the window
+        """
+        if isinstance(windows, WindowIndex):
+            lengths = windows.counts()
+            flat = numpy.concatenate(
+                [numpy.arange(i, j) for i, j in zip(windows.starts,
+                                                    windows.stops)] +
+                [numpy.zeros(0, dtype='int64')])
+        else:
+            seqs = [pandas.DatetimeIndex(seq) for seq in windows]
+            lengths = numpy.array([len(seq) for seq in seqs], dtype='int64')
+            dates = pandas.DatetimeIndex(numpy.concatenate(
+                [seq.asi8 for seq in seqs] + [numpy.zeros(0, dtype='int64')]
+            ).view('datetime64[ns]')).tz_localize('UTC')
+            flat = self._positions(dates)
+            if (flat < 0).any():
+                raise KeyError('dates of windows should be in data')
+        steps = int(lengths.max()) if len(lengths) else 0
+        mask = numpy.arange(steps) < lengths[:, numpy.newaxis]
+        positions = numpy.zeros(mask.shape, dtype='int64')
+        positions[mask] = flat
+
+        sun = self.sun_geometry()
+        elevation = sun['elevation'].values[positions]
+        day = mask & (elevation > 0)
+        sun = (numpy.where(day, elevation, numpy.nan),
+               numpy.where(day, sun['azimuth'].values[positions], numpy.nan),
+               numpy.where(day, sun['irradiance'].values[positions], 0.))
+
+        values = self.variable(what).values[positions]
+        sky_irradiance = numpy.nansum(numpy.where(mask, values, 0), axis=1)
+        sky_el, sky_az, sky_unit = sunsky.sky_sources(sky_type='soc',
+                                                      irradiance=1)
+        sky_irr = sky_irradiance[:, numpy.newaxis] * numpy.asarray(
+            sky_unit)[numpy.newaxis, :]
+        return sun, (sky_el, sky_az, sky_irr)
+
+    def _daylength_table(self, year, elevation=0):
+        """ daylength (hours) of all days of year, indexed by day of year """
+        key = (self.localisation['latitude'], int(year), elevation)
+        if key not in self._daylengths:
+            days = numpy.arange(367)
+            self._daylengths[key] = daylength(numpy.maximum(days, 1), year,
+                                              key[0], elevation)
+        return self._daylengths[key]
+
+    def daylength(self, seq, elevation=0):
+        """ Return an array of the daylength (hours) at the (local) days of
+        the dates of seq
+
+        elevation is the sun elevation (degrees) defining sunrise and sunset
+        (eg -6 includes civil twilight). Daylengths are looked up in per-year
+        tables computed once.
+        """
+        seq = pandas.DatetimeIndex(seq)
+        if seq.tz is not None:
+            seq = seq.tz_convert(self.timezone)
+        years = seq.year.values
+        dayofyear = seq.dayofyear.values
+        result = numpy.empty(len(seq))
+        for year in numpy.unique(years):
+            where = years == year
+            result[where] = self._daylength_table(year, elevation)[
+                dayofyear[where]]
+        return result
+
+    def photoperiod(self, start=None, end=None, elevation=0):
+        """ Return a series of the daylength (hours) of every local day
+        between start and end (default to the first and last days of data)
+        """
+        if start is None or end is None:
+            local = self._data.index.tz_convert(self.timezone)
+            start = local[0].date() if start is None else start
+            end = local[-1].date() if end is None else end
+        days = pandas.date_range(start, end, freq='D', name='date')
+        return pandas.Series(self.daylength(days, elevation), index=days,
+                             name='photoperiod')
+
+    def to_shared(self):
+        """ Copy data (with all declared variables) and qc flags in shared
+        memory blocks, for use by other processes with Weather.from_shared
+
+        Return a small picklable handle. Blocks belong to this instance and
+        are released with unlink_shared.
         """
+        shared = {}
+        for key, frame in (('data', self.data), ('qc_flags', self.qc_flags)):
+            if frame is None:
+                continue
+            shm, layout = to_shared_memory(frame)
+            self._shm.append(shm)
+            shared[key] = layout
+        return {'shared': shared, 'localisation': self.localisation,
+                'timezone': self.timezone.zone, 'data_path': self.data_path,
+                'wind_screen': self.wind_screen,
+                'temperature_screen': self.temperature_screen}
+
+    def unlink_shared(self):
+        """ Release the shared memory blocks created by to_shared
         """
-        return sunsky.day_length(self.localisation['latitude'], seq.dayofyear)
+        while self._shm:
+            shm = self._shm.pop()
+            shm.close()
+            shm.unlink()
+
+    @staticmethod
+    def from_shared(handle):
+        """ Weather instance built on the shared memory blocks of handle (see
+        to_shared) without copying data
+
+        Columns are read-only views: new variables can be added with check,
+        but existing values cannot be modified. Blocks stay attached as long
+        as the process runs.
+        """
+        weather = Weather(wind_screen=handle['wind_screen'],
+                          temperature_screen=handle['temperature_screen'],
+                          localisation=handle['localisation'],
+                          timezone=handle['timezone'])
+        weather.data_path = handle['data_path']
+        frames = {}
+        for key, layout in handle['shared'].items():
+            frames[key] = from_shared_memory(layout, attach(layout['name']),
+                                             copy=False)
+        weather.data = frames.get('data')
+        weather.qc_flags = frames.get('qc_flags')
+        return weather
+
+    @staticmethod
+    def load_many(paths, reader=septo3d_reader, workers=None, **kwds):
+        """ Load several weather files in parallel
+
+        Files are parsed in a pool of workers processes (default to the
+        number of cpus) and data are transferred back through shared memory
+        blocks. reader should be a module level (picklable) function.
+        Other keywords are passed to Weather constructor.
+
+        Return a {path: Weather} dict
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        kwds['reader'] = reader
+        paths = list(paths)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(paths)))
+        if workers == 1:
+            return dict((p, Weather(p, **kwds)) for p in paths)
+        results = []
+        error = None
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [(p, pool.submit(load_worker, p, kwds)) for p in paths]
+            for path, future in futures:
+                try:
+                    results.append((path, future.result()))
+                except Exception as e:
+                    error = error or e
+        # blocks of all workers are unlinked, even if one of them failed
+        pending = [layout for _, layouts in results for layout in layouts if
+                   layout is not None]
+        weathers = {}
+        try:
+            if error is not None:
+                raise error
+            for path, (data, flags) in results:
+                weather = Weather(**dict((k, v) for k, v in kwds.items() if
+                                         k not in ('reader', 'cache_dir')))
+                weather.data_path = path
+                pending.remove(data)
+                weather.data = unlink_layout(data)
+                if flags is not None:
+                    pending.remove(flags)
+                    weather.qc_flags = unlink_layout(flags)
+                weathers[path] = weather
+        finally:
+            for layout in pending:
+                unlink_layout(layout, read=False)
+        return weathers
+
+
+def weather_chunks(data_file, chunksize=24 * 30, reader=septo3d_reader,
+                   varnames=[], models={}, args={}, **kwds):
+    """ iterate over data_file as a sequence of Weather instances of (at most)
+    chunksize time steps each
+
+    Only one chunk is held in memory at a time. Dates of each chunk are
+    localised and the variables listed in varnames are created with
+    Weather.check (see Weather.check for models and args).
+    Cumulative variables (eg degree_days, see cumulative_models) continue from
+    their last value in the previous chunk. As their values before a
+    start_date given in args are counted back from it, chunks preceding the
+    start_date are held until it is read. If qc is set, quality control is applied to each chunk separately
+    (gaps and spikes are not detected across chunk boundaries).
+
+    Readers with a chunksize argument (see septo3d_reader) should return an
+    iterator on dataframes when it is given. Other readers are called once and
+    their output is split. Other keywords are passed to Weather constructor.
+    """
+    if _accepts_chunksize(reader):
+        chunks = reader(data_file, chunksize=chunksize)
+    else:
+        data = reader(data_file)
+        chunks = (data.iloc[i:i + chunksize] for i in
+                  range(0, len(data), chunksize))
+    origin = _cumulative_origin(varnames, models, args)
+    previous = None
+    held = []
+    for chunk in chunks:
+        held.append(_chunk_weather(chunk, kwds))
+        if origin is not None and held[-1]._data.index[-1] < origin:
+            continue
+        for weather in _checked_chunks(held, previous, varnames, models,
+                                       args, kwds):
+            yield weather
+            previous = weather._tail()
+        held = []
+    # start_date after the last date: fails as for a whole Weather
+    for weather in _checked_chunks(held, previous, varnames, models, args,
+                                   kwds):
+        yield weather
+
+
+def _accepts_chunksize(reader):
+    """ True if reader has a chunksize argument """
+    try:
+        parameters = inspect.signature(reader).parameters
+    except (TypeError, ValueError):
+        return False
+    return 'chunksize' in parameters
+
+
+def _cumulative_origin(varnames, models, args):
+    """ latest start_date given to the cumulative models of varnames, None
+    if there is none """
+    origin = None
+    for v in varnames:
+        model = models.get(v, weather_models.get(v))
+        start_date = args.get(v, {}).get('start_date')
+        if model is None or start_date is None or \
+                _as_model(model)[0] not in cumulative_models:
+            continue
+        start_date = pandas.to_datetime(start_date, utc=True)
+        if origin is None or start_date > origin:
+            origin = start_date
+    return origin
+
+
+def _chunk_weather(chunk, kwds):
+    """ a Weather of a chunk of the reader output """
+    weather = Weather(**kwds)
+    data = localise(chunk.copy(), weather.timezone,
+                    kwds.get('ambiguous', 'dst'),
+                    kwds.get('nonexistent', '1h'))
+    qc = kwds.get('qc', False)
+    if qc:
+        data, flags = quality_control(
+            data, **(qc if isinstance(qc, dict) else {}))
+    if kwds.get('compact', False):
+        data = to_compact(data)
+    weather.data = data
+    if qc:
+        weather.qc_flags = flags
+    return weather
+
+
+def _checked_chunks(held, previous, varnames, models, args, kwds):
+    """ check varnames on held chunks, computing cumulative variables over
+    all of them if there are several (chunks preceding a start_date) """
+    if not varnames:
+        return held
+    whole = None
+    if len(held) > 1:
+        whole = Weather(**kwds)
+        whole.data = pandas.concat([w._data for w in held])
+        whole.check(varnames, models, args)
+        if previous is not None:
+            whole._continue_cumulative(previous)
+    start = 0
+    for weather in held:
+        weather.check(varnames, models, args)
+        if whole is not None:
+            weather._take_cumulative(whole, start)
+        elif previous is not None:
+            weather._continue_cumulative(previous)
+        start += len(weather._data)
+    return held
 
 
 def weather_node(weather_path):
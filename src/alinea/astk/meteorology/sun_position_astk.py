@@ -233,12 +233,26 @@ def eot(hUTC, dayofyear, year):
     return (L - ra) / 15.
 
 
-def daylength(dayofyear, year, latitude):
-    """ estimate of daylength"""
+def daylength(dayofyear, year, latitude, elevation=0):
+    """ estimate of daylength (hours)
+
+    Args:
+        dayofyear: (int) the day of year
+        year: (int) the year
+        latitude: (float) latitude (degrees)
+        elevation: (float) sun elevation (degrees) at sunrise and sunset, eg
+            -6 to include civil twilight
+
+    Returns:
+        (float) the duration of the day, 0 during polar night and 24 during
+        polar day
+    """
 
     lat = numpy.radians(latitude)
     dec = declination(12, dayofyear, year)
-    return 12 + 24 / numpy.pi * numpy.arcsin(numpy.tan(lat) - numpy.tan(dec))
+    cos_h0 = (numpy.sin(numpy.radians(elevation)) - numpy.sin(lat) *
+              numpy.sin(dec)) / (numpy.cos(lat) * numpy.cos(dec))
+    return 24 / numpy.pi * numpy.arccos(numpy.clip(cos_h0, -1, 1))
 
 
 def sinel_integral(dayofyear, year, latitude):
@@ -0,0 +1,135 @@
+""" Memory-mapped on-disk archive of weather data for many sites and years
+
+Each site is stored in its own directory:
+    - index.npy : int64 UTC time index (nanoseconds since epoch)
+    - values.npy : float64 array of shape (n_variables, n_times), one row per
+    variable, so that each variable is a contiguous memory-mapped array
+    - meta.json : variable names, localisation and timezone of the site
+
+Opening a site only maps the files, and the weather dataframes returned are
+views on the mapped arrays: only the pages actually touched by a simulation are
+read from disk.
+"""
+import json
+import os
+
+import numpy
+import pandas
+
+from alinea.astk.TimeControl import utc_index
+from alinea.astk.Weather import Weather
+
+
+class WeatherArchive(object):
+    """ A directory of memory-mapped weather data, one sub-directory per site
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # memory maps of the opened sites: (site, file) -> array
+        self._maps = {}
+
+    def sites(self):
+        """ Return the list of sites stored in the archive
+        """
+        return sorted(d for d in os.listdir(self.path) if
+                      os.path.exists(os.path.join(self.path, d, 'meta.json')))
+
+    def add(self, site, weather):
+        """ Store the numerical variables of a Weather instance (or of a UTC
+        indexed dataframe) under name site.
+        """
+        if isinstance(weather, Weather):
+            data = weather.data
+            meta = {'localisation': weather.localisation,
+                    'timezone': weather.timezone.zone}
+        else:
+            data = weather
+            meta = {}
+        data = data.select_dtypes(include=[numpy.number])
+        meta['columns'] = [str(c) for c in data.columns]
+        site_path = os.path.join(self.path, site)
+        for name in ('index.npy', 'values.npy'):
+            self._maps.pop((site, name), None)
+        if not os.path.exists(site_path):
+            os.makedirs(site_path)
+        numpy.save(os.path.join(site_path, 'index.npy'),
+                   utc_index(data.index).asi8)
+        numpy.save(os.path.join(site_path, 'values.npy'),
+                   numpy.ascontiguousarray(data.values.T, dtype='float64'))
+        with open(os.path.join(site_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def meta(self, site):
+        """ Return the metadata of site
+        """
+        with open(os.path.join(self.path, site, 'meta.json')) as f:
+            return json.load(f)
+
+    def index(self, site):
+        """ Return the memory-mapped int64 UTC time index of site
+        """
+        return self._map(site, 'index.npy')
+
+    def values(self, site):
+        """ Return the memory-mapped (variables x times) array of site
+        """
+        return self._map(site, 'values.npy')
+
+    def _map(self, site, name):
+        """ memory map of file name of site, opened once """
+        if (site, name) not in self._maps:
+            self._maps[(site, name)] = numpy.load(
+                os.path.join(self.path, site, name), mmap_mode='r')
+        return self._maps[(site, name)]
+
+    def variable(self, site, what):
+        """ Return the memory-mapped array of a variable of site
+        """
+        columns = self.meta(site)['columns']
+        return self.values(site)[columns.index(what)]
+
+    def bounds(self, site, start=None, end=None):
+        """ Return the positions (i, j) such that index[i:j] covers the dates
+        from start to end (included).
+
+        start and end are anything pandas.Timestamp accepts and are expected
+        in UTC if not localised.
+        """
+        index = self.index(site)
+        i = 0 if start is None else int(numpy.searchsorted(
+            index, utc_index([start]).asi8[0], side='left'))
+        j = len(index) if end is None else int(numpy.searchsorted(
+            index, utc_index([end]).asi8[0], side='right'))
+        return i, j
+
+    def read(self, site, start=None, end=None):
+        """ Return a dataframe of the data of site between start and end
+
+        The dataframe is a read-only view on the memory-mapped values.
+        """
+        i, j = self.bounds(site, start, end)
+        columns = self.meta(site)['columns']
+        index = pandas.DatetimeIndex(
+            numpy.asarray(self.index(site)[i:j]).view('datetime64[ns]'),
+            name='date_utc').tz_localize('UTC')
+        values = self.values(site)[:, i:j]
+        return pandas.DataFrame(values.T, index=index, columns=columns,
+                                copy=False)
+
+    def weather(self, site, start=None, end=None, **kwds):
+        """ Return a Weather instance for site between start and end
+
+        Additional keywords are passed to Weather constructor. localisation
+        and timezone default to the ones stored with the site.
+        """
+        meta = self.meta(site)
+        if 'localisation' in meta:
+            kwds.setdefault('localisation', meta['localisation'])
+        if 'timezone' in meta:
+            kwds.setdefault('timezone', meta['timezone'])
+        weather = Weather(**kwds)
+        weather.data = self.read(site, start, end)
+        return weather
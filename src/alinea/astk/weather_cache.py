@@ -0,0 +1,84 @@
+""" Columnar npz cache of parsed weather files
+
+A cache file holds the int64 UTC time index, one array per column and the
+list of the columns derived with the default weather models, so that loading
+it does not need pickle. Files are named after the parsed file and a key
+identifying its content and the options used to load it (see cache_key).
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy
+import pandas
+
+
+def cache_key(data_file, reader, timezone='UTC', options=None):
+    """ Return a key identifying the parsed content of data_file
+
+    The key changes whenever the path, size or modification time of the file,
+    the reader used to parse it, the timezone used to localise it or the other
+    loading options change.
+    """
+    path = os.path.abspath(data_file)
+    stat = os.stat(path)
+    reader_id = '.'.join([getattr(reader, '__module__', ''),
+                          getattr(reader, '__qualname__',
+                                  getattr(reader, '__name__', repr(reader)))])
+    key = repr((path, stat.st_size, stat.st_mtime_ns, reader_id, str(timezone),
+                options))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cache_path(data_file, cache_dir, reader, timezone='UTC', options=None):
+    """ Return the path of the cache file of data_file in cache_dir
+    """
+    key = cache_key(data_file, reader=reader, timezone=timezone,
+                    options=options)
+    name = os.path.basename(data_file) + '.' + key[:16] + '.npz'
+    return os.path.join(cache_dir, name)
+
+
+def write_cache(path, data, derived=()):
+    """ Save a UTC-indexed weather dataframe as a columnar npz file
+
+    derived lists the columns computed with the default weather_models
+    """
+    arrays = {'index': data.index.asi8,
+              'columns': numpy.array([str(c) for c in data.columns]),
+              'derived': numpy.array([str(c) for c in derived], dtype=str)}
+    for i, c in enumerate(data.columns):
+        arrays['col%d' % i] = data[c].values
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # one temporary file per writer, as several processes may cache the same
+    # file at once: the last replace wins
+    fd, tmp = tempfile.mkstemp(dir=directory or os.curdir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez(f, **arrays)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def read_cache(path, with_derived=False):
+    """ Load a weather dataframe saved with write_cache
+
+    If with_derived is True, return the dataframe and the list of its derived
+    columns
+    """
+    with numpy.load(path) as cached:
+        columns = cached['columns'].tolist()
+        derived = cached['derived'].tolist() if 'derived' in cached else []
+        index = pandas.DatetimeIndex(pandas.to_datetime(cached['index'],
+                                                        utc=True),
+                                     name='date_utc')
+        data = pandas.DataFrame(
+            dict((c, cached['col%d' % i]) for i, c in enumerate(columns)),
+            index=index, columns=columns)
+    if with_derived:
+        return data, derived
+    return data
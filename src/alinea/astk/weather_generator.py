@@ -0,0 +1,145 @@
+""" Deterministic synthetic weather for testing and benchmarking at scale
+
+Generated series have seasonal and diurnal cycles of temperature, global
+radiation equal to the clear sky irradiance (Haurwitz, see
+sky_irradiance_astk.clear_sky_irradiances) attenuated by a random daily
+cloudiness, and stochastic rain events. All variables are computed as
+(sites x times) arrays, and the same seed always gives the same weather.
+"""
+import numpy
+import pandas
+
+from alinea.astk.Weather import Weather, conversion_factor
+from alinea.astk.weather_set import WeatherSet
+from alinea.astk.meteorology.sun_position_astk import sun_elevation
+
+_localisation = {'city': 'Montpellier', 'latitude': 43.61, 'longitude': 3.87}
+
+
+def _smooth_noise(rng, shape, tau):
+    """ zero-mean noise correlated over about tau steps along the last axis:
+    linear interpolation of standard normal values drawn every tau steps """
+    n = shape[-1]
+    knots = rng.standard_normal(shape[:-1] + (int(n / tau) + 2,))
+    x = numpy.arange(n) / float(tau)
+    i = x.astype('int64')
+    f = x - i
+    return knots[..., i] * (1 - f) + knots[..., i + 1] * f
+
+
+def _runs(starts, durations, n):
+    """ boolean mask (sites x n) of runs of given durations beginning at the
+    True positions of starts """
+    marks = numpy.zeros((starts.shape[0], n + 1), dtype='int64')
+    site, pos = numpy.nonzero(starts)
+    ends = numpy.minimum(pos + durations[site, pos], n)
+    numpy.add.at(marks, (site, pos), 1)
+    numpy.add.at(marks, (site, ends), -1)
+    return numpy.cumsum(marks[:, :-1], axis=1) > 0
+
+
+def synthetic_data(index, latitude, longitude, seed=0, mean_temperature=13.,
+                   seasonal_amplitude=8., diurnal_amplitude=5.,
+                   rain_frequency=0.01, rain_duration=4., rain_intensity=1.):
+    """ Generate synthetic weather variables
+
+    Args:
+        index: UTC pandas.DatetimeIndex of the dates
+        latitude: (array of) site latitudes (degrees)
+        longitude: (array of) site longitudes (degrees)
+        seed: (int) the random seed
+        mean_temperature: annual mean air temperature (Celcius)
+        seasonal_amplitude: amplitude of the annual temperature cycle
+        diurnal_amplitude: amplitude of the daily temperature cycle under clear
+         sky
+        rain_frequency: probability that a rain event starts at a given step
+        rain_duration: mean duration (steps) of rain events
+        rain_intensity: mean rain per step (mm) during rain events
+
+    Returns:
+        a {variable: (sites x times) array} dict
+    """
+    rng = numpy.random.RandomState(seed)
+    lat = numpy.atleast_1d(numpy.asarray(latitude, dtype='float64'))
+    lon = numpy.atleast_1d(numpy.asarray(longitude, dtype='float64'))
+    lat, lon = numpy.broadcast_arrays(lat, lon)
+    nsites, n = len(lat), len(index)
+    shape = (nsites, n)
+    lat, lon = lat[:, numpy.newaxis], lon[:, numpy.newaxis]
+
+    hUTC = (index.hour + index.minute / 60.).values[numpy.newaxis, :]
+    dayofyear = index.dayofyear.values[numpy.newaxis, :]
+    year = index.year.values[numpy.newaxis, :]
+    solar_hour = numpy.mod(hUTC + lon / 15., 24)
+    days = ((index.asi8 - index.asi8[0]) // (24 * 3600 * 10 ** 9))
+
+    # daily cloudiness (0 clear, 1 overcast), correlated over a few days
+    ndays = int(days[-1]) + 1 if n else 0
+    cloud = _smooth_noise(rng, (nsites, ndays), 3.)
+    cloud = 1. / (1 + numpy.exp(-1.5 * cloud))
+    cloud = cloud[:, days]
+
+    # clear sky global irradiance (Haurwitz), attenuated by clouds
+    el = sun_elevation(hUTC, dayofyear, year, lat, lon)
+    cosz = numpy.sin(numpy.radians(numpy.maximum(el, 0)))
+    with numpy.errstate(divide='ignore'):
+        ghi = numpy.where(el > 0, 1098 * cosz * numpy.exp(-0.057 / cosz), 0)
+    global_radiation = ghi * (1 - 0.75 * cloud)
+
+    # temperature: annual and daily cycles + correlated noise
+    hemisphere = numpy.where(lat >= 0, 1., -1.)
+    season = numpy.cos(2 * numpy.pi * (dayofyear - 200) / 365.25)
+    daily = numpy.cos(2 * numpy.pi * (solar_hour - 15) / 24.)
+    temperature = (mean_temperature + hemisphere * seasonal_amplitude * season
+                   + diurnal_amplitude * (1 - 0.6 * cloud) * daily
+                   + 2. * _smooth_noise(rng, shape, 24.))
+
+    # rain events starting more often when cloudy
+    starts = rng.random_sample(shape) < rain_frequency * 2 * cloud
+    durations = rng.geometric(1. / rain_duration, shape)
+    wet = _runs(starts, durations, n)
+    rain = numpy.where(wet, rng.exponential(rain_intensity, shape), 0.)
+
+    humidity = 75 - 2.5 * (temperature - temperature.mean(axis=1)[:, None]) \
+        + 15 * wet + 5 * _smooth_noise(rng, shape, 12.)
+    wind = rng.gamma(2., 1., shape) * (0.5 + cloud)
+
+    return {'PPFD': global_radiation * conversion_factor('global_radiation',
+                                                         'PPFD'),
+            'global_radiation': global_radiation,
+            'temperature_air': temperature,
+            'relative_humidity': numpy.clip(humidity, 15, 100),
+            'wind_speed': wind, 'rain': rain}
+
+
+def synthetic_weather(start='2000-01-01', periods=8760, freq='H',
+                      localisation=_localisation, seed=0, **kwds):
+    """ A Weather instance with periods steps of synthetic data
+
+    Other keywords are passed to synthetic_data
+    """
+    index = pandas.date_range(start, periods=periods, freq=freq, tz='UTC',
+                              name='date_utc')
+    data = synthetic_data(index, localisation['latitude'],
+                          localisation['longitude'], seed=seed, **kwds)
+    weather = Weather(localisation=localisation)
+    weather.data = pandas.DataFrame(dict((k, v[0]) for k, v in data.items()),
+                                    index=index)
+    return weather
+
+
+def synthetic_weather_set(localisations, start='2000-01-01', periods=8760,
+                          freq='H', seed=0, sites=None, **kwds):
+    """ A WeatherSet of synthetic data for a list of localisations
+
+    Other keywords are passed to synthetic_data
+    """
+    index = pandas.date_range(start, periods=periods, freq=freq, tz='UTC',
+                              name='date_utc')
+    latitude = [loc['latitude'] for loc in localisations]
+    longitude = [loc['longitude'] for loc in localisations]
+    data = synthetic_data(index, latitude, longitude, seed=seed, **kwds)
+    if sites is None:
+        sites = [loc.get('city', str(i)) for i, loc in
+                 enumerate(localisations)]
+    return WeatherSet(data, index, sites, localisations)
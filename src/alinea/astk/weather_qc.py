@@ -0,0 +1,83 @@
+""" Quality control of measured weather variables
+
+Out of range values and spikes are removed, then short gaps are linearly
+interpolated in time. Each controlled value gets a combination of flag bits.
+"""
+import numpy
+import pandas
+
+
+# quality control flags (bits of Weather.qc_flags values)
+QC_OUT_OF_RANGE = 1
+QC_SPIKE = 2
+QC_MISSING = 4
+QC_INTERPOLATED = 8
+
+# plausible (min, max) values of measured variables
+qc_ranges = {'temperature_air': (-50., 60.), 'relative_humidity': (0., 100.),
+             'PPFD': (0., 3000.), 'global_radiation': (0., 1500.),
+             'wind_speed': (0., 75.), 'rain': (0., 300.)}
+
+# maximal jump of a value relative to both of its neighbours
+qc_spikes = {'temperature_air': 10., 'relative_humidity': 50.}
+
+
+def _fill_gaps(values, times, max_gap):
+    """ linear interpolation (in place) of runs of at most max_gap NaN values
+    surrounded by valid values. Return the mask of interpolated values """
+    missing = numpy.isnan(values)
+    n = len(values)
+    fill = numpy.zeros(n, dtype=bool)
+    if not missing.any() or missing.all() or max_gap <= 0:
+        return fill
+    edges = numpy.diff(numpy.concatenate([[0], missing.view('int8'), [0]]))
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+    ok = ((ends - starts) <= max_gap) & (starts > 0) & (ends < n)
+    marks = numpy.zeros(n + 1, dtype='int64')
+    marks[starts[ok]] += 1
+    marks[ends[ok]] -= 1
+    fill = numpy.cumsum(marks[:-1]) > 0
+    valid = ~missing
+    values[fill] = numpy.interp(times[fill], times[valid], values[valid])
+    return fill
+
+
+def quality_control(data, ranges=qc_ranges, spikes=qc_spikes, max_gap=3):
+    """ Flag and clean measured variables of data
+
+    Values outside ranges and spikes (values jumping by more than spikes[v]
+    relative to both neighbours) are set to NaN. Runs of at most max_gap
+    consecutive missing values are then linearly interpolated in time.
+
+    Return cleaned data and a uint8 dataframe of flags (combination of
+    QC_OUT_OF_RANGE, QC_SPIKE, QC_MISSING and QC_INTERPOLATED bits), with one
+    column per checked variable
+    """
+    times = data.index.asi8.astype('float64')
+    flags = {}
+    for v in data.columns:
+        if v not in ranges and v not in spikes:
+            continue
+        values = data[v].values.astype('float64')
+        flag = numpy.zeros(len(values), dtype='uint8')
+        if v in ranges:
+            low, high = ranges[v]
+            out = (values < low) | (values > high)
+            flag[out] |= QC_OUT_OF_RANGE
+            values[out] = numpy.nan
+        if v in spikes and len(values) > 2:
+            before = values[1:-1] - values[:-2]
+            after = values[1:-1] - values[2:]
+            spike = numpy.zeros(len(values), dtype=bool)
+            spike[1:-1] = ((numpy.abs(before) > spikes[v]) &
+                           (numpy.abs(after) > spikes[v]) &
+                           (numpy.sign(before) == numpy.sign(after)))
+            flag[spike] |= QC_SPIKE
+            values[spike] = numpy.nan
+        flag[numpy.isnan(values) & (flag == 0)] |= QC_MISSING
+        flag[_fill_gaps(values, times, max_gap)] |= QC_INTERPOLATED
+        if flag.any():
+            data[v] = values
+        flags[v] = flag
+    return data, pandas.DataFrame(flags, index=data.index)
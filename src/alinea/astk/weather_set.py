@@ -0,0 +1,245 @@
+""" Weather data of many sites sharing a common time axis
+
+Variables are stored as (sites x times) arrays indexed by one shared UTC
+DatetimeIndex, so that derived variables, sun path and light sources are
+computed for all sites in one vectorised call.
+"""
+import numpy
+import pandas
+import pytz
+import pvlib
+from pvlib.spa import atmospheric_refraction_correction
+
+from alinea.astk.TimeControl import utc_index
+from alinea.astk.Weather import Psat, conversion_factor
+from alinea.astk.meteorology.sun_position_astk import sun_elevation, \
+    sun_azimuth
+from alinea.astk.meteorology.sun_position import sun_extraradiation
+from alinea.astk.meteorology.sky_irradiance import air_mass, _altitude
+import alinea.astk.sun_and_sky as sunsky
+
+
+def global_radiation(weather_set):
+    """ Global radiation (W.m-2) from PPFD (micromol.m-2.s-1) for all sites
+    (see Weather.PPFD_to_global)
+    """
+    return weather_set.data['PPFD'] * conversion_factor('PPFD',
+                                                        'global_radiation')
+
+
+def PPFD(weather_set):
+    """ PPFD (micromol.m-2.s-1) from global radiation (W.m-2) for all sites
+    (see Weather.global_to_PPFD)
+    """
+    return weather_set.data['global_radiation'] * conversion_factor(
+        'global_radiation', 'PPFD')
+
+
+def vapor_pressure(weather_set):
+    """ Water vapor pressure (kPa) from relative humidity (%) and air
+    temperature (Celcius) for all sites
+    """
+    data = weather_set.data
+    return data['relative_humidity'] / 100. * Psat(data['temperature_air'])
+
+
+def degree_days(weather_set, start_date=None, base_temp=0., max_temp=35.):
+    """ Linear thermal time accumulation for all sites (see
+    Weather.linear_degree_days)
+    """
+    t = weather_set.data['temperature_air']
+    t = numpy.where((t < base_temp) | (t > max_temp), 0., t)
+    dd = numpy.cumsum((t - base_temp) / 24., axis=1)
+    if start_date is None:
+        i = 0
+    else:
+        i = weather_set.index.searchsorted(utc_index([start_date])[0])
+    return dd - dd[:, i:i + 1]
+
+
+class WeatherSet(object):
+    """ Weather data of several sites on a shared time axis
+
+        - data is a {variable: array} dict of (sites x times) arrays
+        - index is a UTC localised pandas.DatetimeIndex of the times
+        - sites is a list of site names
+        - localisations is a list of {'city', 'latitude', 'longitude'} dict,
+        one per site
+        - timezone indicates the standard timezone name (see pytz infos)
+
+    Sun positions are computed for all sites at once with the astk equations
+    (sun_position_astk) corrected for atmospheric refraction, and clear sky
+    irradiances with the pvlib Ineichen model, as in Weather. For a same site,
+    day time elevations and azimuths agree with Weather.sun_geometry within
+    0.1 degree and direct irradiances within 5 W.m-2.
+    """
+
+    def __init__(self, data, index, sites, localisations,
+                 timezone='UTC'):
+        self.data = dict(data)
+        self.index = utc_index(index)
+        self.sites = list(sites)
+        self.localisations = list(localisations)
+        self.timezone = pytz.timezone(timezone)
+        self.models = {'global_radiation': global_radiation,
+                       'vapor_pressure': vapor_pressure,
+                       'PPFD': PPFD,
+                       'degree_days': degree_days}
+
+    @property
+    def latitude(self):
+        return numpy.array([loc['latitude'] for loc in self.localisations])
+
+    @property
+    def longitude(self):
+        return numpy.array([loc['longitude'] for loc in self.localisations])
+
+    def site(self, name):
+        """ Return the data of one site as a dataframe
+        """
+        i = self.sites.index(name)
+        return pandas.DataFrame(
+            dict((k, v[i]) for k, v in self.data.items()), index=self.index)
+
+    def positions(self, time_sequence):
+        """ Return the positions of the dates of time_sequence in index
+
+        Raise KeyError if some dates are not in index
+        """
+        positions = self.index.get_indexer(utc_index(time_sequence))
+        if (positions < 0).any():
+            raise KeyError('dates of time_sequence should be in index')
+        return positions
+
+    def get_weather(self, time_sequence):
+        """ Return a {variable: (sites x times) array} dict of the data between
+        the first and last date of time_sequence
+        """
+        time_sequence = utc_index(time_sequence)
+        i = self.index.searchsorted(time_sequence[0], side='left')
+        j = self.index.searchsorted(time_sequence[-1], side='right')
+        return dict((k, v[:, i:j]) for k, v in self.data.items())
+
+    def get_variable(self, what, time_sequence):
+        """ Return the (sites x times) values of what at dates of time_sequence
+        """
+        return self.data[what][:, self.positions(time_sequence)]
+
+    def check(self, varnames=[], models={}, args={}):
+        """ Check if varnames are in data and try to create them if absent
+        using default models or models provided in arg.
+        Return a bool list with True if the variable is present or has been
+        succesfully created, False otherwise.
+
+        Parameters:
+
+        - varnames : a list of name of variable to check
+        - models a dict (name: model) of models to use to generate the data.
+        models receive the weather set as argument and return a (sites x times)
+        array
+        """
+        all_models = dict(self.models)
+        all_models.update(models)
+        check = []
+        for v in varnames:
+            if v in self.data:
+                check.append(True)
+            elif v in all_models:
+                self.data[v] = all_models[v](self, **args.get(v, {}))
+                check.append(True)
+            else:
+                check.append(False)
+        return check
+
+    def sun_path(self, seq=None):
+        """ Return a {'elevation', 'azimuth', 'zenith'} dict of (sites x times)
+        arrays of apparent sun position (degrees) at dates of seq (default to
+        index)
+
+        Night positions are kept (with negative elevations).
+        """
+        if seq is None:
+            seq = self.index
+        seq = utc_index(seq)
+        hUTC = (seq.hour + seq.minute / 60.).values[numpy.newaxis, :]
+        dayofyear = seq.dayofyear.values[numpy.newaxis, :]
+        year = seq.year.values[numpy.newaxis, :]
+        lat = self.latitude[:, numpy.newaxis]
+        lon = self.longitude[:, numpy.newaxis]
+        el = sun_elevation(hUTC, dayofyear, year, lat, lon)
+        az = sun_azimuth(hUTC, dayofyear, year, lat, lon)
+        # refraction for the pressure and temperature used by pvlib
+        # get_solarposition (see sun_position.sun_position)
+        el = el + atmospheric_refraction_correction(
+            pvlib.atmosphere.alt2pres(_altitude) / 100., 12, el, 0.5667)
+        return {'elevation': el, 'azimuth': az, 'zenith': 90 - el}
+
+    def light_sources(self, seq, what='global_radiation'):
+        """ return direct and diffuse light sources representing the sky and
+        the sun of all sites for a given time period indicated by seq
+
+        Returns:
+            sun: elevation, azimuth and horizontal irradiance of sun sources,
+            as (sites x times) arrays. Irradiances are clear sky (Ineichen)
+            direct irradiances, as in Weather, and are set to zero during
+            night.
+            sky: elevation, azimuth of sky sources and (sites x sources) array
+            of irradiance, with sky irradiance of each site equal to the sum of
+            what over seq
+        """
+        seq = utc_index(seq)
+        sun = self.sun_path(seq)
+        el = sun['elevation']
+        day = el > 0
+        zenith = numpy.where(day, sun['zenith'], 0)
+        dni_extra = numpy.asarray(sun_extraradiation(seq))[numpy.newaxis, :]
+        # turbidity tables depend on the site, other terms are elementwise
+        turbidity = numpy.array(
+            [pvlib.clearsky.lookup_linke_turbidity(seq, loc['latitude'],
+                                                   loc['longitude']).values
+             for loc in self.localisations])
+        clear_sky = pvlib.clearsky.ineichen(zenith,
+                                            air_mass(zenith, _altitude),
+                                            turbidity, altitude=_altitude,
+                                            dni_extra=dni_extra)
+        sun_irradiance = numpy.where(day, clear_sky['ghi'] - clear_sky['dhi'],
+                                     0)
+
+        sky_irradiance = self.get_variable(what, seq).sum(axis=1)
+        sky_el, sky_az, sky_unit = sunsky.sky_sources(sky_type='soc',
+                                                          irradiance=1)
+        sky_irr = sky_irradiance[:, numpy.newaxis] * numpy.asarray(
+            sky_unit)[numpy.newaxis, :]
+        return (el, sun['azimuth'], sun_irradiance), (sky_el, sky_az, sky_irr)
+
+    def linear_degree_days(self, start_date=None, base_temp=0., max_temp=35.):
+        """ Linear thermal time accumulation of all sites as a (sites x times)
+        array
+        """
+        return degree_days(self, start_date=start_date, base_temp=base_temp,
+                           max_temp=max_temp)
+
+
+def weather_set(weathers, timezone='UTC'):
+    """ Build a WeatherSet from a {site: Weather} dict
+
+    The shared index is the union of the indices of all weathers, missing
+    values are filled with NaN. Only numerical variables present in all
+    weathers are kept.
+    """
+    sites = list(weathers)
+    frames = [weathers[s].data for s in sites]
+    index = frames[0].index
+    for df in frames[1:]:
+        if not df.index.equals(index):
+            index = index.union(df.index)
+    columns = [c for c in frames[0].select_dtypes(include=[numpy.number])
+               if all(c in df.columns for df in frames)]
+    data = {}
+    for c in columns:
+        values = numpy.empty((len(sites), len(index)))
+        for i, df in enumerate(frames):
+            values[i] = df[c].reindex(index).values
+        data[c] = values
+    localisations = [weathers[s].localisation for s in sites]
+    return WeatherSet(data, index, sites, localisations, timezone=timezone)
@@ -0,0 +1,124 @@
+""" Transport of weather dataframes between processes in shared memory
+
+Columns of a same dtype are stored as one (columns x times) array in a
+multiprocessing SharedMemory block, next to the int64 UTC time index. A small
+picklable layout allows other processes to map the block without copy.
+"""
+import numpy
+import pandas
+
+
+def to_shared_memory(data):
+    """ Copy the index and columns of a UTC-indexed dataframe in a new
+    multiprocessing SharedMemory block.
+
+    Columns of the same dtype are stored together as one (columns x times)
+    array, so that from_shared_memory can map them without copy.
+    Return the block and a picklable layout allowing to rebuild the dataframe
+    with from_shared_memory. Columns that are not plain arrays (eg objects) are
+    kept in the layout.
+    """
+    from multiprocessing import shared_memory
+    groups = {}
+    objects = {}
+    for c in data.columns:
+        values = data[c].values
+        if isinstance(values, numpy.ndarray) and values.dtype != object:
+            groups.setdefault(values.dtype.str, []).append(c)
+        else:
+            objects[c] = values
+    n = len(data)
+    layout = []
+    offset = 0
+    for dtype, names in [('<i8', ['__index__'])] + list(groups.items()):
+        # 8 bytes alignment of every block
+        layout.append((dtype, names, n, offset))
+        offset += (len(names) * n * numpy.dtype(dtype).itemsize + 7) // 8 * 8
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for dtype, names, n, start in layout:
+        block = numpy.frombuffer(shm.buf, dtype=dtype, count=len(names) * n,
+                                 offset=start).reshape(len(names), n)
+        for i, name in enumerate(names):
+            block[i] = data.index.asi8 if name == '__index__' else data[name]
+    return shm, {'name': shm.name, 'blocks': layout, 'objects': objects,
+                 'columns': list(data.columns)}
+
+
+def from_shared_memory(layout, shm=None, copy=True):
+    """ Rebuild a dataframe stored with to_shared_memory
+
+    If copy is False, the columns are read-only views on the shared memory
+    block, that should stay attached (and not be unlinked) as long as the
+    dataframe is used. Columns are then ordered by dtype.
+    """
+    from multiprocessing import shared_memory
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=layout['name'])
+    frames = []
+    index = None
+    for dtype, names, n, start in layout['blocks']:
+        block = numpy.frombuffer(shm.buf, dtype=dtype, count=len(names) * n,
+                                 offset=start).reshape(len(names), n)
+        if copy:
+            block = block.copy()
+        else:
+            block.flags.writeable = False
+        if names == ['__index__']:
+            index = pandas.DatetimeIndex(block[0].view('M8[ns]'),
+                                         name='date_utc').tz_localize('UTC')
+        else:
+            frames.append((names, block))
+    frames = [pandas.DataFrame(block.T, index=index, columns=names,
+                               copy=False) for names, block in frames]
+    for name, values in layout['objects'].items():
+        frames.append(pandas.DataFrame({name: values}, index=index))
+    if not frames:
+        return pandas.DataFrame(index=index, columns=layout['columns'])
+    data = pandas.concat(frames, axis=1, copy=False)
+    if copy:
+        data = data.loc[:, layout['columns']]
+    return data
+
+
+def load_worker(path, kwds):
+    """ parse path in a worker process, return the shared memory layout of
+    data (and of qc flags) """
+    from multiprocessing import resource_tracker
+    from alinea.astk.Weather import Weather
+    weather = Weather(path, **kwds)
+    layouts = []
+    for frame in (weather.data, weather.qc_flags):
+        if frame is None:
+            layouts.append(None)
+            continue
+        shm, layout = to_shared_memory(frame)
+        # the parent process is responsible for unlinking the block
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        shm.close()
+        layouts.append(layout)
+    return layouts
+
+
+# shared memory blocks used by Weather.from_shared in this process. They are
+# never closed, as dataframes built on them may outlive their weather
+_attached_blocks = {}
+
+
+def attach(name):
+    """ shared memory block name, attached once in this process """
+    from multiprocessing import shared_memory
+    if name not in _attached_blocks:
+        _attached_blocks[name] = shared_memory.SharedMemory(name=name)
+    return _attached_blocks[name]
+
+
+def unlink_layout(layout, read=True):
+    """ copy of the dataframe of layout (if read), its block is unlinked """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=layout['name'])
+    try:
+        if read:
+            return from_shared_memory(layout, shm)
+    finally:
+        shm.close()
+        shm.unlink()
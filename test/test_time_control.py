@@ -0,0 +1,88 @@
+import numpy
+import pandas
+
+from alinea.astk.TimeControl import evaluation_sequence, IterWithDelays, \
+    time_control, time_filter, date_filter, rain_events, rain_filter
+from alinea.astk.Weather import Weather
+from alinea.astk.data_access import get_path
+
+
+def test_evaluation_sequence():
+    seq = evaluation_sequence([1, 3, 2])
+    assert seq.tolist() == [True, True, False, False, True, False]
+    assert evaluation_sequence([2., 0, 1]).tolist() == [True, False, True]
+    assert len(evaluation_sequence([24] * 1000)) == 24000
+
+
+def test_iter_with_delays():
+    timing = IterWithDelays(['a', 'b'], [2, 3])
+    steps = list(timing)
+    assert len(steps) == 5
+    assert [bool(s) for s in steps] == [True, False, True, False, False]
+    assert [s.value for s in steps] == ['a', 'a', 'b', 'b', 'b']
+    assert [s.dt for s in steps] == [2, 2, 3, 3, 3]
+
+
+def test_time_control():
+    index = pandas.date_range('2000-10-01', periods=48, freq='H', tz='UTC')
+    data = pandas.DataFrame({'rain': numpy.arange(48.)}, index=index)
+    seq = pandas.date_range('2000-10-01 02:00', periods=24, freq='H')
+    eval_filter = [i % 5 == 0 for i in range(24)]
+    values, delays = time_control(seq, eval_filter, data)
+    assert len(values) == len(delays) == 5
+    assert delays.tolist() == [5, 5, 5, 5, 3]
+    assert values[0]['rain'].tolist() == [2, 3, 4, 5, 6]
+    assert values[4]['rain'].tolist() == [22, 23, 24, 25]
+    assert sum(len(v) for v in values) == 24
+    steps = list(IterWithDelays(values, delays))
+    assert len(steps) == 23
+    nodata, delays = time_control(seq, eval_filter)
+    assert nodata == [None] * 5
+
+
+def test_time_filter():
+    seq = pandas.date_range('2000-10-01', periods=48, freq='H')
+    assert time_filter(seq, 3).tolist() == [i % 3 == 0 for i in range(48)]
+    assert time_filter(seq, '1D').sum() == 2
+    seq = pandas.date_range('2000-10-01', periods=12, freq='5min')
+    assert time_filter(seq, 0.25).tolist() == [i % 3 == 0 for i in range(12)]
+    seq = pandas.date_range('2000-10-01', periods=24 * 10, freq='H')
+    assert numpy.nonzero(time_filter(seq, '3D'))[0].tolist() == [0, 72, 144,
+                                                                  216]
+
+
+def test_date_filter():
+    seq = pandas.date_range('2000-10-01', periods=24, freq='H')
+    dates = pandas.to_datetime(['2000-10-01 05:00', '2000-10-01 08:20',
+                                '2000-10-02 05:00'])
+    calendar = pandas.DataFrame({'dose': [1.5, 2, 1.2]}, index=dates)
+    assert numpy.nonzero(date_filter(seq, calendar))[0].tolist() == [5]
+    snapped = date_filter(seq, calendar, tolerance='30min')
+    assert numpy.nonzero(snapped)[0].tolist() == [5, 8]
+    assert date_filter(seq, calendar, tolerance=0.25).sum() == 1
+    local = seq.tz_localize('Europe/Paris')
+    assert numpy.nonzero(date_filter(local, calendar))[0].tolist() == [7]
+
+
+def test_rain_events():
+    index = pandas.date_range('2000-10-01', periods=10, freq='H', tz='UTC')
+    weather = Weather()
+    weather.data = pandas.DataFrame(
+        {'rain': [0, 1, 2, 0.1, 0, 3, 0, 0, 0.5, 0.6]}, index=index)
+    seq = pandas.date_range('2000-10-01', periods=10, freq='H')
+    events = rain_events(seq, weather)
+    assert events['start'].tolist() == seq[[1, 5, 8]].tolist()
+    assert events['end'].tolist() == seq[[2, 5, 9]].tolist()
+    assert events['duration'].tolist() == [2, 1, 2]
+    numpy.testing.assert_allclose(events['total'], [3, 3, 1.1])
+    numpy.testing.assert_allclose(events['peak'], [2, 3, 0.6])
+    assert numpy.nonzero(rain_filter(seq, weather))[0].tolist() == [0, 1, 3,
+                                                                     5, 6, 8]
+
+
+def test_rain_filter():
+    weather = Weather(get_path('meteo00-01.txt'))
+    seq = weather.data.index[100:2000]
+    rain = weather.data['rain'].values[100:2000] > 0.2
+    expected = [True] + (rain[1:] != rain[:-1]).tolist()
+    assert rain_filter(seq, weather).tolist() == expected
@@ -1,4 +1,14 @@
-from alinea.astk.Weather import Weather
+import os
+import shutil
+import tempfile
+import numpy
+import pandas
+import pytz
+
+from alinea.astk.Weather import Weather, septo3d_reader, weather_chunks, \
+    localise, convert, conversion_factor
+from alinea.astk.weather_qc import quality_control, QC_MISSING, \
+    QC_INTERPOLATED, QC_OUT_OF_RANGE, QC_SPIKE
 from alinea.astk.data_access import get_path
 
 
@@ -20,3 +30,482 @@ def test_date_range_index():
     index = weather.date_range_index('2000-12-31', '2001-01-02', by=24)
     assert len(index) == 2
     assert len(index[0]) == 24
+
+
+def test_septo3d_reader():
+    path = get_path('meteo00-01.txt')
+    data = septo3d_reader(path)
+    assert data.index[0] == pandas.Timestamp('2000-10-01 01:00:00')
+    assert data.index[23] == pandas.Timestamp('2000-10-02 00:00:00')
+    assert 'An' not in data.columns
+    assert (data.index == data['date']).all()
+
+
+def test_cache():
+    path = get_path('meteo00-01.txt')
+    cache_dir = tempfile.mkdtemp()
+    try:
+        _check_cache(path, cache_dir)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def _check_cache(path, cache_dir):
+    weather = Weather(path, cache_dir=cache_dir)
+    assert os.path.exists(weather.cache_file)
+    weather.check(['global_radiation', 'vapor_pressure'])
+    assert 'global_radiation' in weather.data.columns
+    cached = Weather(path, cache_dir=cache_dir)
+    assert cached.cache_file == weather.cache_file
+    pandas.testing.assert_frame_equal(cached.data, weather.data,
+                                      check_freq=False)
+    other = Weather(path, cache_dir=cache_dir, timezone='Europe/Paris')
+    assert other.cache_file != weather.cache_file
+    assert 'global_radiation' not in other.data.columns
+    # columns derived with caller models or args are not cached
+    other.check(['degree_days'], args={'degree_days': {'base_temp': 10}})
+    assert 'degree_days' in other.data.columns
+    default = Weather(path, cache_dir=cache_dir, timezone='Europe/Paris')
+    assert 'degree_days' not in default.data.columns
+    default.check(['degree_days'])
+    dd = default.data['degree_days'].values
+    assert (dd > other.data['degree_days'].values).any()
+    # cached default columns are recomputed for other args
+    warm = Weather(path, cache_dir=cache_dir, timezone='Europe/Paris')
+    numpy.testing.assert_allclose(warm.data['degree_days'], dd)
+    warm.check(['degree_days'], args={'degree_days': {'base_temp': 10}})
+    numpy.testing.assert_allclose(warm.data['degree_days'],
+                                  other.data['degree_days'])
+    # values set by the user are not cached
+    ppfd = warm.data['PPFD'].values.copy()
+    warm.set_variable('PPFD', 2 * ppfd)
+    warm.check(['global_radiation', 'vapor_pressure'])
+    assert warm.data['global_radiation'].sum() > 0
+    reloaded = Weather(path, cache_dir=cache_dir, timezone='Europe/Paris')
+    numpy.testing.assert_array_equal(reloaded.data['PPFD'], ppfd)
+    assert 'global_radiation' not in reloaded.data.columns
+    assert 'vapor_pressure' in reloaded.data.columns
+    # a removed cache file is rewritten with all cacheable columns
+    os.remove(reloaded.cache_file)
+    reloaded.check(['global_radiation'])
+    reloaded.data
+    rewritten = Weather(path, cache_dir=cache_dir, timezone='Europe/Paris')
+    assert list(rewritten.data.columns) == list(reloaded.data.columns)
+    pandas.testing.assert_frame_equal(rewritten.data, reloaded.data,
+                                      check_freq=False)
+    # assigned data is detached from the cache file
+    for data in (rewritten.data.iloc[:240],
+                 rewritten.data.assign(PPFD=rewritten.data['PPFD'] * 10)):
+        weather = Weather(path, cache_dir=cache_dir)
+        weather.data = data.drop(['global_radiation', 'vapor_pressure'],
+                                 axis=1)
+        assert weather.cache_file is None
+        weather.check(['global_radiation'])
+        assert len(weather.data['global_radiation']) == len(data)
+    cached = Weather(path, cache_dir=cache_dir)
+    numpy.testing.assert_allclose(cached.data['global_radiation'],
+                                  cached.data['PPFD'] / 4.6 / 0.48)
+
+
+def _cached_length(path, cache_dir):
+    return len(Weather(path, cache_dir=cache_dir).data)
+
+
+def test_concurrent_cache():
+    from concurrent.futures import ProcessPoolExecutor
+    path = get_path('meteo00-01.txt')
+    for _ in range(3):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with ProcessPoolExecutor(max_workers=4) as pool:
+                lengths = list(pool.map(_cached_length, [path] * 4,
+                                        [cache_dir] * 4))
+            assert lengths == [7296] * 4
+            assert [f for f in os.listdir(cache_dir) if
+                    f.endswith('.tmp')] == []
+            assert len(Weather(path, cache_dir=cache_dir).data) == 7296
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+def test_weather_chunks():
+    path = get_path('meteo00-01.txt')
+    weather = Weather(path)
+    chunks = list(weather_chunks(path, chunksize=1000,
+                                 varnames=['global_radiation', 'degree_days']))
+    assert len(chunks) == 8
+    assert sum(len(w.data) for w in chunks) == len(weather.data)
+    assert chunks[1].data.index[0] == weather.data.index[1000]
+    assert 'global_radiation' in chunks[-1].data.columns
+    # cumulative variables continue across chunks
+    weather.check(['degree_days'])
+    numpy.testing.assert_allclose(
+        numpy.concatenate([w.data['degree_days'].values for w in chunks]),
+        weather.data['degree_days'].values)
+    # also when chunks end before the start_date of degree days
+    for start_date in ('2001-03-01', '2000-10-01 12:00'):
+        dd_args = {'degree_days': {'start_date': start_date}}
+        chunks = list(weather_chunks(path, chunksize=1000,
+                                     varnames=['degree_days'], args=dd_args))
+        assert [len(w.data) for w in chunks[:-1]] == [1000] * 7
+        whole = Weather(path)
+        whole.check(['degree_days'], args=dd_args)
+        numpy.testing.assert_allclose(
+            numpy.concatenate([w.data['degree_days'].values for w in chunks]),
+            whole.data['degree_days'].values)
+    chunks = weather_chunks(path, chunksize=1000, qc=True)
+    chunk = next(chunks)
+    assert chunk.qc_flags.shape == (1000, len(chunk.qc_flags.columns))
+    assert chunk.qc_flags.index.equals(chunk.data.index)
+    # readers without chunksize are split, errors of the others are raised
+    chunks = list(weather_chunks(path, chunksize=1000,
+                                 reader=lambda p: septo3d_reader(p)))
+    assert [len(w.data) for w in chunks[:-1]] == [1000] * 7
+
+    def failing(data_file, chunksize=None):
+        raise TypeError('bad file')
+    try:
+        next(weather_chunks(path, reader=failing))
+        assert False
+    except TypeError as e:
+        assert 'bad file' in str(e)
+
+
+def test_localise():
+    data = pandas.DataFrame({'date': pandas.to_datetime(
+        ['2000-03-26 01:00', '2000-03-26 02:00', '2000-03-26 03:00',
+         '2000-10-29 02:00'])})
+    utc = localise(data.copy(), pytz.timezone('Europe/Paris')).index
+    expected = pandas.to_datetime(['2000-03-26 00:00', '2000-03-26 01:00',
+                                   '2000-03-26 01:00', '2000-10-29 00:00'],
+                                  utc=True)
+    assert (utc == expected).all()
+    # same as pytz localize of the reader timestamps
+    tz = pytz.timezone('Europe/Paris')
+    assert [pandas.Timestamp(tz.localize(d)).tz_convert('UTC') for d in
+            data['date']] == list(utc)
+    utc = localise(data.copy(), pytz.timezone('Europe/Paris'),
+                   ambiguous='standard', nonexistent='NaT').index
+    assert pandas.isnull(utc[1])
+    assert utc[3] == pandas.Timestamp('2000-10-29 01:00', tz='UTC')
+
+
+def test_lazy_check():
+    weather = Weather(get_path('meteo00-01.txt'))
+    models = {}
+    assert weather.check(['global_radiation', 'degree_days', 'unknown'],
+                         models=models) == [True, True, False]
+    assert models == {}
+    assert 'global_radiation' not in weather._data.columns
+    seq = weather._data.index[:24]
+    assert weather.get_variable('global_radiation', seq).sum() > 0
+    assert 'global_radiation' in weather._data.columns
+    assert 'degree_days' not in weather._data.columns
+    assert 'degree_days' in weather.data.columns
+
+    weather.set_variable('PPFD', weather.data['PPFD'] * 2)
+    assert 'global_radiation' not in weather._data.columns
+    rg = weather.variable('global_radiation')
+    numpy.testing.assert_allclose(rg.values,
+                                  weather.data['PPFD'].values / 4.6 / 0.48)
+
+    # later plain checks keep variables built with given models or args
+    weather = Weather(get_path('meteo00-01.txt'))
+    weather.check(['degree_days'], args={'degree_days': {'base_temp': 10}})
+    weather.check(['global_radiation'],
+                  models={'global_radiation': lambda d: d['PPFD']})
+    dd = weather.variable('degree_days').values.copy()
+    weather.check(['degree_days', 'global_radiation'])
+    numpy.testing.assert_array_equal(weather.variable('degree_days'), dd)
+    numpy.testing.assert_array_equal(weather.variable('global_radiation'),
+                                     weather.data['PPFD'])
+    weather.check(['degree_days'])
+    weather.check(['degree_days'], args={'degree_days': {}})
+    assert weather.variable('degree_days').values[-1] > dd[-1]
+
+
+def test_set_pending_variable():
+    weather = Weather(get_path('meteo00-01.txt'))
+    weather.check(['global_radiation'])
+    values = numpy.ones(len(weather._data))
+    weather.set_variable('global_radiation', values)
+    numpy.testing.assert_array_equal(weather.data['global_radiation'], values)
+
+
+def test_plain_model():
+    weather = Weather(get_path('meteo00-01.txt'))
+    # plain models may use variables checked before them
+    assert weather.check(['global_radiation', 'rg_half'], models={
+        'rg_half': lambda d: d['global_radiation'] * .5}) == [True, True]
+    numpy.testing.assert_allclose(weather.variable('rg_half'),
+                                  weather.variable('global_radiation') * .5)
+    # a failing model is reported once, then dropped
+    weather = Weather(get_path('meteo00-01.txt'))
+    weather.check(['broken'], models={'broken': lambda d: d['missing']})
+    try:
+        weather.data
+        assert False
+    except KeyError as e:
+        assert 'missing' in str(e)
+    assert 'broken' not in weather.data.columns
+    seq = weather.data.index[:24]
+    assert len(weather.get_weather(seq)) == 24
+
+
+def test_get_weather():
+    weather = Weather(get_path('meteo00-01.txt'))
+    seq = pandas.date_range('2000-12-02', periods=24, freq='H', tz='UTC')
+    assert weather.window(seq[0], seq[-1]) == (1487, 1511)
+    expected = weather.data.truncate(before=seq[0], after=seq[-1])
+    assert weather.get_weather(seq).equals(expected)
+    assert len(weather.get_weather_start(seq)) == 1
+    arrays = weather.get_arrays(seq, ['rain'])
+    numpy.testing.assert_array_equal(arrays['rain'], expected['rain'].values)
+    assert numpy.shares_memory(arrays['rain'], weather.data['rain'].values)
+
+
+def test_windows():
+    weather = Weather(get_path('meteo00-01.txt'))
+    windows = weather.windows(24, '2000-10-05 03:00', 10)
+    assert len(windows) == 10
+    assert (windows.counts() == 24).all()
+    first = weather.data.truncate(before='2000-10-05 03:00',
+                                  after='2000-10-06 02:00')
+    assert windows[0].equals(first)
+    reduced = windows.reduce('sum', ['rain', 'PPFD'])
+    numpy.testing.assert_allclose(reduced.iloc[0].values,
+                                  first[['rain', 'PPFD']].sum().values)
+    reduced = windows.reduce('max', ['temperature_air'])
+    assert reduced['temperature_air'].iloc[0] == first['temperature_air'].max()
+    assert len(weather.split_weather(24, '2000-10-05 03:00', 10)) == 10
+
+
+def test_at_resolution():
+    weather = Weather(get_path('meteo00-01.txt'), timezone='Europe/Paris')
+    daily = weather.at_resolution('D')
+    assert len(daily) == 305
+    assert weather.at_resolution('D') is daily
+    local = weather.data.tz_convert('Europe/Paris')
+    expected = local.resample('D').agg({'rain': 'sum',
+                                        'temperature_air': 'mean'})
+    numpy.testing.assert_allclose(daily[['rain', 'temperature_air']].values,
+                                  expected.values)
+    daily = weather.at_resolution('D', rules={'temperature_air': 'max'})
+    numpy.testing.assert_allclose(daily['temperature_air'].values,
+                                  local['temperature_air'].resample(
+                                      'D').max().values)
+    for freq in ('W', 'M'):
+        expected = local.resample(freq).agg({'rain': 'sum',
+                                             'temperature_air': 'mean'})
+        numpy.testing.assert_allclose(
+            weather.at_resolution(freq)[['rain', 'temperature_air']].values,
+            expected.values)
+    # missing values are skipped, as with resample
+    temperature = weather.data['temperature_air'].values.copy()
+    temperature[5] = numpy.nan
+    weather.set_variable('temperature_air', temperature)
+    daily = weather.at_resolution('D')
+    assert not daily['temperature_air'].isnull().any()
+    weather.set_variable('rain', weather.data['rain'] * 2)
+    assert weather.at_resolution('D')['rain'].sum() == 2 * local[
+        'rain'].sum()
+    # the cache is cleared by append and data assignment
+    daily = weather.at_resolution('D')
+    rows = weather.data.iloc[-24:].copy()
+    rows.index = rows.index + pandas.Timedelta('1D')
+    weather.append(rows.drop('date', axis=1))
+    assert len(weather.at_resolution('D')) == len(daily) + 1
+    weather.data = weather.data.iloc[:24 * 10]
+    assert len(weather.at_resolution('D')) < len(daily)
+
+
+def test_quality_control():
+    data = septo3d_reader(get_path('meteo00-01.txt'))
+    t = data.columns.get_loc('temperature_air')
+    data.iloc[10:12, t] = float('nan')
+    data.iloc[20, t] = 99
+    data.iloc[30, t] = data.iloc[29, t] + 15
+    data.iloc[40:50, t] = float('nan')
+    cleaned, flags = quality_control(data.copy(), max_gap=3)
+    assert flags['temperature_air'].dtype == numpy.uint8
+    assert list(flags['temperature_air'].iloc[[10, 20, 30, 45]]) == [
+        QC_MISSING | QC_INTERPOLATED, QC_OUT_OF_RANGE | QC_INTERPOLATED,
+        QC_SPIKE | QC_INTERPOLATED, QC_MISSING]
+    tair = cleaned['temperature_air']
+    assert tair.iloc[:40].notnull().all()
+    assert tair.iloc[40:50].isnull().all()
+    assert tair.iloc[10] == data.iloc[9, t] + (data.iloc[12, t] -
+                                               data.iloc[9, t]) / 3.
+
+    weather = Weather(get_path('meteo00-01.txt'), qc=True)
+    assert weather.qc_flags.shape[0] == len(weather.data)
+
+
+def test_compact():
+    path = get_path('meteo00-01.txt')
+    weather = Weather(path)
+    compact = Weather(path, compact=True)
+    assert 'date' not in compact.data.columns
+    assert (compact.data.dtypes == numpy.float32).all()
+    assert compact.data.memory_usage().sum() < weather.data.memory_usage(
+        ).sum() / 1.9
+    varnames = ['global_radiation', 'vapor_pressure', 'degree_days']
+    weather.check(varnames)
+    compact.check(varnames)
+    for v in varnames:
+        numpy.testing.assert_allclose(compact.data[v].values,
+                                      weather.data[v].values.ravel(),
+                                      rtol=1e-6)
+
+
+def test_load_many():
+    path = get_path('meteo00-01.txt')
+    weathers = Weather.load_many([path, path], workers=2, qc=True)
+    assert list(weathers) == [path]
+    weather = Weather(path, qc=True)
+    assert weathers[path].data.equals(weather.data)
+    assert weathers[path].qc_flags.equals(weather.qc_flags)
+    # shared blocks are released when a file fails to load
+    shm = '/dev/shm'
+    before = set(os.listdir(shm)) if os.path.isdir(shm) else set()
+    try:
+        Weather.load_many([path, path + '.missing', path], workers=2)
+        assert False
+    except IOError:
+        pass
+    if os.path.isdir(shm):
+        assert set(os.listdir(shm)) == before
+
+
+def test_sun_geometry():
+    weather = Weather(get_path('meteo00-01.txt'))
+    weather.check(['global_radiation'])
+    geometry = weather.sun_geometry()
+    assert len(geometry) == len(weather.data)
+    assert weather.sun_geometry() is geometry
+    seq = pandas.date_range('2001-06-21', periods=24, freq='H', tz='UTC')
+    sun, sky = weather.light_sources(seq)
+    path = weather.sun_path(seq)
+    assert len(sun[0]) == len(path) == 15
+    numpy.testing.assert_allclose(sun[0], path['elevation'].values)
+    assert (sun[2] > 0).all()
+    # local time: the shifted spring DST hour repeats a UTC date
+    weather = Weather(get_path('meteo00-01.txt'), timezone='Europe/Paris')
+    weather.check(['global_radiation'])
+    assert not weather.data.index.is_unique
+    geometry = weather.sun_geometry()
+    assert len(geometry) == len(weather.data)
+    seq = pandas.date_range('2001-03-24 22:00', periods=24, freq='H',
+                            tz='UTC')
+    sun, sky = weather.light_sources(seq)
+    path = weather.sun_path(seq)
+    assert len(sun[0]) == len(path) > 0
+    numpy.testing.assert_allclose(sun[0], path['elevation'].values)
+    batch, _ = weather.light_sources_batch([seq])
+    numpy.testing.assert_allclose(batch[0][0][~numpy.isnan(batch[0][0])],
+                                  sun[0])
+
+
+def test_append():
+    path = get_path('meteo00-01.txt')
+    whole = Weather(path, timezone='Europe/Paris')
+    whole.check(['global_radiation', 'degree_days'])
+    raw = septo3d_reader(path)
+    weather = Weather(timezone='Europe/Paris')
+    weather.data = localise(raw.iloc[:5000].copy(), weather.timezone)
+    weather.check(['global_radiation', 'degree_days'])
+    geometry = weather.sun_geometry()
+    weather.append(raw.iloc[5000:])
+    assert len(weather.data) == len(whole.data)
+    assert weather.data.index.equals(whole.data.index)
+    numpy.testing.assert_allclose(weather.data['degree_days'],
+                                  whole.data['degree_days'])
+    numpy.testing.assert_allclose(weather.data['global_radiation'],
+                                  whole.data['global_radiation'])
+    assert len(weather.sun_geometry()) == len(whole.data)
+    assert weather.sun_geometry().iloc[:5000].equals(geometry)
+    try:
+        weather.append(raw.iloc[:10])
+        assert False
+    except ValueError:
+        pass
+    # rows indexed by dates get the local dates of data
+    weather = Weather(timezone='Europe/Paris')
+    weather.data = localise(raw.iloc[:5000].copy(), weather.timezone)
+    weather.append(whole.data.iloc[5000:].drop('date', axis=1))
+    assert weather.data['date'].notnull().all()
+    assert (weather.data['date'].values == whole.data['date'].values).all()
+
+
+def test_light_sources_batch():
+    weather = Weather(get_path('meteo00-01.txt'))
+    weather.check(['global_radiation'])
+    seqs = [pandas.date_range('2001-06-%02d' % d, periods=24 + d, freq='H',
+                              tz='UTC') for d in range(1, 5)]
+    sun, sky = weather.light_sources_batch(seqs)
+    assert sun[0].shape == (4, 28)
+    assert sky[2].shape == (4, len(sky[0]))
+    for i, seq in enumerate(seqs):
+        (el, az, irr), (_, _, sky_irr) = weather.light_sources(seq)
+        day = ~numpy.isnan(sun[0][i])
+        numpy.testing.assert_allclose(sun[0][i][day], el)
+        numpy.testing.assert_allclose(sun[2][i][day], irr)
+        assert (sun[2][i][~day] == 0).all()
+        numpy.testing.assert_allclose(sky[2][i], sky_irr)
+    windows = weather.windows(24, '2001-06-01', 4)
+    sun_w, sky_w = weather.light_sources_batch(windows)
+    _, (_, _, sky_irr) = weather.light_sources(seqs[0][:24])
+    numpy.testing.assert_allclose(sky_w[2][0], sky_irr)
+    numpy.testing.assert_allclose(sun_w[2][0], sun[2][0][:24])
+
+
+def test_daylength():
+    weather = Weather(get_path('meteo00-01.txt'), timezone='Europe/Paris')
+    seq = pandas.date_range('2001-06-21', periods=48, freq='H', tz='UTC')
+    d = weather.daylength(seq)
+    assert d.shape == (48,)
+    assert 15 < d[12] < 15.5
+    assert weather.daylength(seq, elevation=-6)[12] > d[12]
+    photoperiod = weather.photoperiod()
+    assert len(photoperiod) == len(numpy.unique(
+        weather.data.index.tz_convert('Europe/Paris').date))
+    assert photoperiod['2000-12-21'] < 9 < photoperiod['2001-06-21']
+
+
+def test_conversions():
+    weather = Weather(get_path('meteo00-01.txt'))
+    assert conversion_factor('PPFD', 'rain') is None
+    numpy.testing.assert_allclose(conversion_factor('PPFD', 'NIR'),
+                                  0.52 / 0.48 / 4.6)
+    assert weather.check(['NIR', 'vapor_pressure']) == [True, True]
+    assert 'global_radiation' not in weather.data.columns
+    data = weather.data
+    numpy.testing.assert_allclose(data['NIR'], data['PPFD'] / 4.6 / 0.48 *
+                                  0.52)
+    T = data['temperature_air']
+    numpy.testing.assert_allclose(data['vapor_pressure'],
+                                  data['relative_humidity'] / 100. * 0.6108 *
+                                  numpy.exp(17.27 * T / (237.3 + T)))
+    out = numpy.empty(len(data))
+    result = convert(data, 'NIR', 'PPFD', out=out)
+    assert result is out
+    numpy.testing.assert_allclose(out, data['PPFD'])
+
+
+def test_shared():
+    weather = Weather(get_path('meteo00-01.txt'), qc=True)
+    weather.check(['global_radiation'])
+    handle = weather.to_shared()
+    try:
+        shared = Weather.from_shared(handle)
+        data = shared.data
+        assert data.index.equals(weather.data.index)
+        for c in weather.data.columns:
+            numpy.testing.assert_array_equal(data[c], weather.data[c])
+            assert not data[c].values.flags.writeable
+        assert shared.qc_flags.shape == weather.qc_flags.shape
+        assert shared.timezone == weather.timezone
+        shared.check(['vapor_pressure'])
+        assert 'vapor_pressure' in shared.data.columns
+    finally:
+        weather.unlink_shared()
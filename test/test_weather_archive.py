@@ -0,0 +1,41 @@
+import shutil
+import tempfile
+
+import numpy
+import pandas
+
+from alinea.astk.Weather import Weather
+from alinea.astk.weather_archive import WeatherArchive
+from alinea.astk.data_access import get_path
+
+
+def test_archive():
+    path = tempfile.mkdtemp()
+    try:
+        _check_archive(WeatherArchive(path))
+    finally:
+        shutil.rmtree(path)
+
+
+def _check_archive(archive):
+    weather = Weather(get_path('meteo00-01.txt'))
+    archive.add('montpellier', weather)
+    assert archive.sites() == ['montpellier']
+    assert 'date' not in archive.meta('montpellier')['columns']
+    rain = archive.variable('montpellier', 'rain')
+    assert isinstance(rain, numpy.memmap)
+    numpy.testing.assert_array_equal(rain, weather.data['rain'].values)
+
+    # read returns views on the memory-mapped values, without copy
+    data = archive.read('montpellier', '2000-12-01', '2000-12-31 23:00')
+    values = archive.values('montpellier')
+    for c in data.columns:
+        assert numpy.shares_memory(data[c].values, values)
+
+    sub = archive.weather('montpellier', '2000-12-01', '2000-12-31 23:00')
+    assert len(sub.data) == 31 * 24
+    assert sub.localisation == weather.localisation
+    seq = pandas.date_range('2000-12-02', periods=24, freq='H', tz='UTC')
+    numpy.testing.assert_array_equal(sub.get_weather(seq)['rain'].values,
+                                     weather.get_weather(seq)['rain'].values)
+    assert sub.check(['global_radiation']) == [True]
@@ -0,0 +1,30 @@
+import numpy
+
+from alinea.astk.weather_generator import synthetic_weather, \
+    synthetic_weather_set
+
+
+def test_synthetic_weather():
+    weather = synthetic_weather(periods=24 * 365, seed=1)
+    assert len(weather.data) == 24 * 365
+    assert weather.data.equals(synthetic_weather(periods=24 * 365,
+                                                 seed=1).data)
+    assert not weather.data.equals(synthetic_weather(periods=24 * 365,
+                                                     seed=2).data)
+    data = weather.data
+    assert (data['global_radiation'] >= 0).all()
+    night = data['global_radiation'] == 0
+    assert 0.3 < night.mean() < 0.7
+    assert 0 < (data['rain'] > 0).mean() < 0.2
+    daily = weather.at_resolution('D')['temperature_air']
+    assert daily.iloc[180:200].mean() > daily.iloc[:20].mean() + 5
+    assert weather.check(['vapor_pressure', 'degree_days']) == [True, True]
+
+
+def test_synthetic_weather_set():
+    localisations = [{'city': 'a', 'latitude': 45., 'longitude': 0.},
+                     {'city': 'b', 'latitude': -30., 'longitude': 20.}]
+    ws = synthetic_weather_set(localisations, periods=48)
+    assert ws.sites == ['a', 'b']
+    assert ws.data['temperature_air'].shape == (2, 48)
+    assert numpy.isfinite(ws.data['relative_humidity']).all()
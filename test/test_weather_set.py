@@ -0,0 +1,82 @@
+import numpy
+import pandas
+
+from alinea.astk.Weather import Weather
+from alinea.astk.weather_set import weather_set
+from alinea.astk.data_access import get_path
+
+
+def _weathers():
+    path = get_path('meteo00-01.txt')
+    north = {'city': 'Lille', 'latitude': 50.63, 'longitude': 3.06}
+    return {'montpellier': Weather(path),
+            'lille': Weather(path, localisation=north)}
+
+
+def test_weather_set():
+    weathers = _weathers()
+    ws = weather_set(weathers)
+    assert ws.data['rain'].shape == (2, 7296)
+    assert ws.check(['global_radiation', 'degree_days', 'unknown']) == [
+        True, True, False]
+    w = weathers['lille']
+    w.check(['global_radiation', 'degree_days'])
+    i = ws.sites.index('lille')
+    numpy.testing.assert_allclose(ws.data['global_radiation'][i],
+                                  w.data['global_radiation'].values)
+    numpy.testing.assert_allclose(ws.data['degree_days'][i],
+                                  w.data['degree_days'].values)
+
+
+def test_light_sources():
+    ws = weather_set(_weathers())
+    ws.check(['global_radiation'])
+    seq = pandas.date_range('2000-12-02', periods=24, freq='H', tz='UTC')
+    sun, sky = ws.light_sources(seq)
+    assert sun[0].shape == (2, 24)
+    assert sky[2].shape == (2, 46)
+    numpy.testing.assert_allclose(sky[2].sum(axis=1),
+                                  ws.get_variable('global_radiation',
+                                                  seq).sum(axis=1))
+    # shorter days in the north in winter
+    assert (sun[0][1] > 0).sum() < (sun[0][0] > 0).sum()
+
+
+def test_missing_dates():
+    ws = weather_set(_weathers())
+    seq = pandas.date_range('1990-01-01', periods=24, freq='H', tz='UTC')
+    try:
+        ws.get_variable('rain', seq)
+        assert False
+    except KeyError:
+        pass
+    try:
+        ws.light_sources(seq, 'rain')
+        assert False
+    except KeyError:
+        pass
+
+
+def test_same_as_weather():
+    weathers = _weathers()
+    ws = weather_set(weathers)
+    for date in ('2001-03-21', '2001-06-21'):
+        seq = pandas.date_range(date, periods=24, freq='H', tz='UTC')
+        sun, _ = ws.light_sources(seq, 'rain')
+        for i, site in enumerate(ws.sites):
+            weather = weathers[site]
+            geometry = weather.sun_geometry().iloc[weather._positions(seq)]
+            day = geometry['elevation'].values > 0
+            numpy.testing.assert_array_equal(sun[0][i] > 0, day)
+            numpy.testing.assert_allclose(sun[0][i][day],
+                                          geometry['elevation'].values[day],
+                                          atol=0.1)
+            numpy.testing.assert_allclose(sun[1][i][day],
+                                          geometry['azimuth'].values[day],
+                                          atol=0.1)
+            numpy.testing.assert_allclose(sun[2][i],
+                                          geometry['irradiance'].values,
+                                          atol=5)
+            numpy.testing.assert_allclose(sun[2][i].sum(),
+                                          geometry['irradiance'].sum(),
+                                          rtol=0.01)